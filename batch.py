@@ -0,0 +1,195 @@
+"""
+Identification of a whole test campaign: every case_<case>_dof<i>_m.dat group found in the given directories or globs
+is run through pipeline.run_case in a process pool.
+
+Each finished case (identified or failed) is appended at once to progress.jsonl in the output directory, so an
+interrupted campaign resumes with the cases still missing when run again. Records hold the hash of the settings they
+were run with, so a case only counts as done for the same settings, and results.csv consolidates the last record of
+every case run with the current settings: parameters, residual RMS per dof, stage timings and errors. Cases missing a
+dof file, or whose number of dof files differs from the number of dof_masses, are reported as failed without running
+them. Worker processes are replaced after max_tasks_per_child cases, which bounds the memory a worker can accumulate.
+With --figures, each worker also renders the figures of its cases headless (Agg backend) to the figures folder of the
+output directory.
+
+    python batch.py data/campaign_2 --out results/campaign_2 --settings settings.json --processes 4
+
+settings.json overrides pipeline.DEFAULT_SETTINGS, e.g. {"dof_masses": [32.37, 26.007], "use_smoothed": true}.
+"""
+import argparse
+import csv
+import glob
+import json
+import multiprocessing
+import os
+import re
+import time
+import traceback
+from typing import List
+from pipeline import case_summary, merge_settings, run_stages, STAGES
+from stage_cache import settings_hash, StageCache
+
+CASE_PATTERN = re.compile(r'case_(?P<case>.+)_dof(?P<dof>\d+)_m\.dat$')
+PROGRESS_FILENAME = 'progress.jsonl'
+RESULTS_FILENAME = 'results.csv'
+FIGURES_DIRNAME = 'figures'
+
+
+def find_cases(inputs: List[str], n_dofs: int = None):
+    """
+    Groups the case_<case>_dof<i>_m.dat files in inputs (directories or glob patterns) by case.
+
+    :param n_dofs: Expected number of dof files of every case, e.g. the number of dof_masses of the settings.
+    :returns: dict case -> list of full filenames sorted by dof, for the cases with dofs 1, 2, ... n (and n equal to
+    n_dofs, if given), and dict case -> error message for the other ones.
+    """
+    filenames = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, 'case_*_dof*_m.dat')
+        filenames.extend(glob.glob(pattern))
+    cases = {}
+    for full_filename in sorted(set(filenames)):
+        match = CASE_PATTERN.search(os.path.basename(full_filename))
+        if match is not None:
+            cases.setdefault(match.group('case'), {})[int(match.group('dof'))] = full_filename
+    incomplete = {}
+    for case, dof_files in list(cases.items()):
+        errors = []
+        if n_dofs is not None and len(dof_files) != n_dofs:
+            errors.append(f'expected {n_dofs} dof files, found {len(dof_files)}')
+        missing = sorted(set(range(1, max(max(dof_files), n_dofs or 0) + 1)) - set(dof_files))
+        if missing:
+            errors.append(f'missing dofs {missing}')
+        if errors:
+            incomplete[case] = f'Dof files of case {case}: ' + ', '.join(errors)
+            del cases[case]
+        else:
+            cases[case] = [dof_files[dof] for dof in sorted(dof_files)]
+    return cases, incomplete
+
+
+def read_progress(progress_filename: str):
+    """
+    :returns: dict case -> last record of progress_filename. A truncated last line (interrupted write) is ignored.
+    """
+    records = {}
+    if os.path.exists(progress_filename):
+        with open(progress_filename) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                records[record['case']] = record
+    return records
+
+
+def _run_case_task(task):
+    case, responses_full_filenames, settings, stage_cache_dir, figures_dir = task
+    t_ini = time.perf_counter()
+    record = {'case': case, 'files': responses_full_filenames, 'pid': os.getpid(),
+              'settings_hash': settings_hash(settings)}
+    try:
+        stage_cache = StageCache(stage_cache_dir) if stage_cache_dir is not None else None
+        outputs = run_stages(responses_full_filenames, settings, stage_cache)
+        record.update(case_summary(outputs), status='ok')
+        if figures_dir is not None:
+            t_figures = time.perf_counter()
+            import matplotlib.pyplot as plt
+            plt.switch_backend('Agg')
+            from myplots import save_case_figures
+            record['figures'] = save_case_figures(outputs, figures_dir, case)
+            record['timings']['figures'] = time.perf_counter() - t_figures
+        record['solver_report'] = {key: value if isinstance(value, str) else float(value)
+                                   for key, value in record['solver_report'].items()}
+        record['unknown'] = {name: float(value) for name, value in record['unknown'].items()}
+    except Exception as error:
+        record.update(status='failed', error=f'{type(error).__name__}: {error}', traceback=traceback.format_exc(),
+                      timings={'total': time.perf_counter() - t_ini})
+    return record
+
+
+def write_results(records: dict, results_filename: str):
+    """
+    Writes one row per case of records (see read_progress) to results_filename.
+    """
+    names = sorted({name for record in records.values() for name in record.get('unknown', {})})
+    n_dofs = max([len(record.get('residual_rms', [])) for record in records.values()] + [0])
+    header = ['case', 'status', 'settings_hash', 'n_samples'] + names + \
+        [f'residual_rms_dof{i + 1}' for i in range(n_dofs)] + [f'time_{stage}' for stage in STAGES + ['total']] + \
+        ['error']
+    with open(results_filename, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        for case in sorted(records):
+            record = records[case]
+            residual_rms = record.get('residual_rms', [])
+            writer.writerow([case, record['status'], record.get('settings_hash', ''),
+                             record.get('n_samples', '')] +
+                            [record.get('unknown', {}).get(name, '') for name in names] +
+                            [residual_rms[i] if i < len(residual_rms) else '' for i in range(n_dofs)] +
+                            [record['timings'].get(stage, '') for stage in STAGES + ['total']] +
+                            [record.get('error', '')])
+
+
+def run_batch(inputs: List[str], out_dir: str, settings: dict = None, processes: int = None,
+              max_tasks_per_child: int = 1, retry_failed: bool = False, stage_cache_dir: str = None,
+              figures: bool = False):
+    """
+    Runs every case found in inputs (see find_cases) not yet identified in out_dir with the same settings, and writes
+    results.csv.
+
+    :param retry_failed: Flag to run again the cases that failed in previous runs.
+    :param stage_cache_dir: Optional folder of a stage_cache.StageCache shared by the workers.
+    :param figures: Flag to render the figures of every case run (see myplots.save_case_figures) in its worker.
+    :returns: dict case -> record of every case of the campaign.
+    """
+    settings = merge_settings(settings)
+    os.makedirs(out_dir, exist_ok=True)
+    progress_filename = os.path.join(out_dir, PROGRESS_FILENAME)
+    current_hash = settings_hash(settings)
+    records = {case: record for case, record in read_progress(progress_filename).items()
+               if record.get('settings_hash') == current_hash}
+    cases, incomplete = find_cases(inputs, len(settings['dof_masses']))
+    done = {case for case, record in records.items() if record['status'] == 'ok' or not retry_failed}
+    figures_dir = os.path.join(out_dir, FIGURES_DIRNAME) if figures else None
+    tasks = [(case, filenames, settings, stage_cache_dir, figures_dir) for case, filenames in cases.items()
+             if case not in done]
+    print(f'{len(cases)} cases found, {len(cases) - len(tasks)} already done, {len(tasks)} to run')
+    for case, error in incomplete.items():
+        print(f'case {case}: failed ({error})')
+    if tasks:
+        with multiprocessing.Pool(processes, maxtasksperchild=max_tasks_per_child) as pool, \
+                open(progress_filename, 'a') as progress_file:
+            for i_task, record in enumerate(pool.imap_unordered(_run_case_task, tasks), start=1):
+                progress_file.write(json.dumps(record) + '\n')
+                progress_file.flush()
+                os.fsync(progress_file.fileno())
+                records[record['case']] = record
+                print(f"[{i_task}/{len(tasks)}] case {record['case']}: {record['status']} "
+                      f"({record['timings']['total']:.2f} s){' ' + record['error'] if 'error' in record else ''}")
+    records = {case: record for case, record in records.items() if case in cases}
+    records.update({case: {'case': case, 'status': 'failed', 'error': error, 'settings_hash': current_hash,
+                           'timings': {}} for case, error in incomplete.items()})
+    write_results(records, os.path.join(out_dir, RESULTS_FILENAME))
+    return records
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', help='directories or glob patterns of case_*_dof*_m.dat files')
+    parser.add_argument('--out', default='batch_results', help='output directory')
+    parser.add_argument('--settings', default=None, help='JSON file overriding pipeline.DEFAULT_SETTINGS')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--max_tasks_per_child', type=int, default=1,
+                        help='cases run by a worker process before it is replaced')
+    parser.add_argument('--retry_failed', action='store_true', help='run again the cases that failed before')
+    parser.add_argument('--stage_cache', default=None, help='folder of the on-disk cache of stage outputs')
+    parser.add_argument('--figures', action='store_true', help='render the figures of every case headless')
+    args = parser.parse_args()
+    settings_override = None
+    if args.settings is not None:
+        with open(args.settings) as settings_file:
+            settings_override = json.load(settings_file)
+    run_batch(args.inputs, args.out, settings_override, args.processes, args.max_tasks_per_child, args.retry_failed,
+              args.stage_cache, args.figures)
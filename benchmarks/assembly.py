@@ -0,0 +1,118 @@
+"""
+Assembly time of get_ab_mats_assembly for chain-like and fully connected models, compared with the former
+implementation that grew A with np.vstack/np.hstack and matched shared elements with Element.is_same_as.
+
+Run from the repository root:
+
+    python -m benchmarks.assembly --n_samples 200
+"""
+import argparse
+import time
+from typing import List
+import numpy as np
+from lumped_mass_sysid import DOF, get_ab_mats_assembly, get_elements_assembly
+from utils import check_responses_integrity, Parameters
+
+
+def legacy_get_ab_mats(responses: List[dict], parameters: dict, dof_index: int):
+    dof = DOF(responses, parameters, index=dof_index)
+    b_mat = - dof.mass * responses[dof_index]['x_ddot'].reshape((-1, 1))
+    a_columns = []
+    for element in dof.elements:
+        if element.element_type == 'k':
+            a_columns.append(responses[dof.index]['x'] - responses[element.j]['x'])
+        elif element.element_type == 'c':
+            a_columns.append(responses[dof.index]['x_dot'] - responses[element.j]['x_dot'])
+        elif element.element_type == 'b':
+            a_columns.append(responses[dof.index]['x_ddot'] - responses[element.j]['x_ddot'])
+        elif element.element_type == 'k2':
+            a_columns.append((responses[dof.index]['x'] - responses[element.j]['x'])**2)
+        elif element.element_type == 'k3':
+            a_columns.append((responses[dof.index]['x'] - responses[element.j]['x'])**3)
+        elif element.element_type == 'muN':
+            a_columns.append(np.sign(responses[dof.index]['x_dot'] - responses[element.j]['x_dot']))
+        a_columns[-1] = a_columns[-1].reshape(-1, 1)
+    return np.hstack(a_columns), b_mat, dof
+
+
+def legacy_get_ab_mats_assembly(responses: List[dict], parameters: dict, dof_indexes: List[int]):
+    n_samples = check_responses_integrity(responses)
+    a_mat_assembly, b_mat_assembly, _ = legacy_get_ab_mats(responses, parameters, dof_indexes[0])
+    elements_assembly = _.elements
+    for i_dof, dof_index in enumerate(dof_indexes[1:], start=1):
+        a_mat_next, b_mat_next, dof_next = legacy_get_ab_mats(responses, parameters, dof_index)
+        b_mat_assembly = np.vstack((b_mat_assembly, b_mat_next))
+        a_mat_assembly = np.vstack((a_mat_assembly, np.zeros((n_samples, a_mat_assembly.shape[1]))))
+        for i_element_next, element_next in enumerate(dof_next.elements):
+            is_present = False
+            for i_element, element in enumerate(elements_assembly):
+                if element_next.is_same_as(element):
+                    a_mat_assembly[-n_samples:, i_element] = a_mat_next[:, i_element_next]
+                    is_present = True
+                    break
+            if not is_present:
+                a_mat_assembly = np.hstack((a_mat_assembly, np.zeros((n_samples * (1 + i_dof), 1))))
+                a_mat_assembly[-n_samples:, -1] = a_mat_next[:, i_element_next]
+                elements_assembly.append(element_next)
+    return a_mat_assembly, b_mat_assembly, elements_assembly
+
+
+def random_responses(n_dofs: int, n_samples: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    zeros = np.zeros(n_samples)
+    responses = [{'x': zeros, 'x_dot': zeros, 'x_ddot': zeros}]
+    for _ in range(n_dofs):
+        responses.append({key: rng.standard_normal(n_samples) for key in ('x', 'x_dot', 'x_ddot')})
+    return responses
+
+
+def time_call(func, *args, repeat: int = 3):
+    best = np.inf
+    for _ in range(repeat):
+        t_ini = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - t_ini)
+    return best
+
+
+def time_model_setup(n_dofs: int = 200, repeat: int = 3):
+    """
+    Time to build a fully connected k/c model and resolve its elements and per dof incidence, before any numerics.
+    """
+    def setup():
+        parameters = Parameters(dof_masses=[1.0] * n_dofs, fully_connected_k=True, fully_connected_c=True).parameters
+        get_elements_assembly(None, parameters, list(range(1, n_dofs + 1)))
+    return time_call(setup, repeat=repeat)
+
+
+def main(n_dofs_list=(2, 10, 50), n_samples: int = 200, repeat: int = 3, max_legacy_columns: int = np.inf):
+    print(f'{"model":>16} {"n_dofs":>6} {"columns":>7} {"before (s)":>11} {"after (s)":>10} {"speedup":>8}')
+    for topology in ('chain', 'fully_connected'):
+        for n_dofs in n_dofs_list:
+            fully_connected = topology == 'fully_connected'
+            parameters = Parameters(dof_masses=[1.0] * n_dofs,
+                                    fully_connected_k=fully_connected, fully_connected_c=fully_connected).parameters
+            responses = random_responses(n_dofs, n_samples)
+            dof_indexes = list(range(1, n_dofs + 1))
+            a_mat, _, _ = get_ab_mats_assembly(responses, parameters, dof_indexes)
+            t_after = time_call(get_ab_mats_assembly, responses, parameters, dof_indexes, repeat=repeat)
+            if a_mat.shape[1] <= max_legacy_columns:
+                a_mat_legacy, _, _ = legacy_get_ab_mats_assembly(responses, parameters, dof_indexes)
+                assert np.array_equal(a_mat, a_mat_legacy), 'assembly differs from the legacy implementation'
+                t_before = time_call(legacy_get_ab_mats_assembly, responses, parameters, dof_indexes, repeat=repeat)
+            else:
+                t_before = np.nan
+            print(f'{topology:>16} {n_dofs:>6} {a_mat.shape[1]:>7} {t_before:>11.4f} {t_after:>10.4f} '
+                  f'{t_before / t_after:>8.1f}')
+    print(f'200-DOF fully connected model setup: {time_model_setup(200, repeat=repeat):.4f} s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n_dofs', type=int, nargs='+', default=[2, 10, 50])
+    parser.add_argument('--n_samples', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--max_legacy_columns', type=float, default=np.inf,
+                        help='skip the legacy implementation for models with more unknowns than this')
+    args = parser.parse_args()
+    main(args.n_dofs, args.n_samples, args.repeat, args.max_legacy_columns)
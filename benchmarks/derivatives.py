@@ -0,0 +1,87 @@
+"""
+Speed of the differentiators of derivatives.differentiate, compared with the former per dof chained np.diff of
+get_responses, and stability of the k and c identified with each of them on sliding windows of the bundled records
+(the spread of a parameter over the windows of a stationary test should be small).
+
+Run from the repository root:
+
+    python -m benchmarks.derivatives --n_samples 1000000 --window 2000
+"""
+import argparse
+import numpy as np
+from benchmarks.assembly import time_call
+from derivatives import differentiate
+from utils import get_responses, Parameters
+from windowed_identification import sliding_window_identification
+
+SETTINGS = [('diff', {}),
+            ('central', {}),
+            ('savgol', {'window': 11, 'polyorder': 3}),
+            ('savgol', {'window': 31, 'polyorder': 3}),
+            ('savgol', {'window': 101, 'polyorder': 3}),
+            ('spectral', {}),
+            ('spectral', {'cutoff': 50.0})]
+
+
+def legacy_differentiate(x: np.ndarray, delta_t: float):
+    responses = []
+    for x_dof in x:
+        responses.append({'x': x_dof[0:-2],
+                          'x_dot': np.diff(x_dof[0:-1]) / delta_t,
+                          'x_ddot': np.diff(x_dof, 2) / (delta_t ** 2)})
+    return responses
+
+
+def settings_label(differentiator: str, settings: dict):
+    return ' '.join([differentiator] + [f'{key}={value}' for key, value in settings.items()])
+
+
+def time_differentiators(n_dofs: int = 4, n_samples: int = 10 ** 6, delta_t: float = 0.002, repeat: int = 3):
+    x = np.cumsum(np.random.default_rng(0).standard_normal((n_dofs, n_samples)), axis=1)
+    t_legacy = time_call(legacy_differentiate, x, delta_t, repeat=repeat)
+    print(f'{"differentiator":>32} {"time (s)":>9} {"vs legacy diff":>15}')
+    print(f'{"legacy diff":>32} {t_legacy:9.4f} {1:15.2f}')
+    for differentiator, settings in SETTINGS:
+        elapsed = time_call(lambda: differentiate(x, delta_t, differentiator, **settings), repeat=repeat)
+        print(f'{settings_label(differentiator, settings):>32} {elapsed:9.4f} {t_legacy / elapsed:15.2f}')
+
+
+def stability(responses_full_filenames, dof_masses, window: int = 2000, step: int = 100, max_disp: float = .015):
+    """
+    Median and relative spread ((p90 - p10) / median) of each k and c identified on sliding windows, for each
+    differentiator, on the raw and on the smoothed records.
+    """
+    parameters = Parameters(dof_masses=dof_masses, fully_connected_c=True).parameters
+    dof_indexes = list(range(1, len(dof_masses) + 1))
+    for use_smoothed in (False, True):
+        print(f'\n{"smoothed" if use_smoothed else "raw"} records, windows of {window} samples every {step}')
+        names = None
+        for differentiator, settings in SETTINGS:
+            t, responses = get_responses(responses_full_filenames, True, True, use_smoothed=use_smoothed,
+                                         max_disp=max_disp, differentiator=differentiator,
+                                         differentiator_settings=settings)
+            trajectories = sliding_window_identification(responses, parameters, dof_indexes, window, step)
+            if names is None:
+                names = [name for name in trajectories['unknown'] if name.split('_')[0] in ('k', 'c')]
+                print(f'{"differentiator":>32} ' + ' '.join(f'{name:>20}' for name in names))
+            cells = []
+            for name in names:
+                p10, p50, p90 = np.percentile(trajectories['unknown'][name], [10, 50, 90])
+                cells.append(f'{p50:11.4g} ±{abs(p90 - p10) / abs(p50):7.1%}')
+            print(f'{settings_label(differentiator, settings):>32} ' + ' '.join(cells))
+
+
+def main(n_dofs: int = 4, n_samples: int = 10 ** 6, repeat: int = 3, window: int = 2000, step: int = 100):
+    time_differentiators(n_dofs, n_samples, repeat=repeat)
+    stability(['txy_dof1_m.dat', 'txy_dof2_m.dat'], [32.37, 26.007], window, step)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n_dofs', type=int, default=4)
+    parser.add_argument('--n_samples', type=int, default=10 ** 6)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--window', type=int, default=2000, help='samples per identification window')
+    parser.add_argument('--step', type=int, default=100)
+    args = parser.parse_args()
+    main(args.n_dofs, args.n_samples, args.repeat, args.window, args.step)
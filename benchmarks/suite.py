@@ -0,0 +1,238 @@
+"""
+Scaling benchmark of the identification on synthetic cases (see benchmarks/synthetic.py): wall time and peak memory
+of each stage of pipeline.run_stages (load, differentiate, assemble, solve) and relative error of the identified
+parameters, over a grid of numbers of samples and dofs. Every point runs in a fresh process, so its peak resident
+memory is its own; the peak of each stage is the one traced by tracemalloc over the arrays already allocated, in a
+first, untimed run of the stage.
+
+Points with more than max_values samples x dofs are skipped (by default 2e7: up to 10M samples of 2 dofs, 1M of 10 or
+100k of 100). The results are written as JSON after every point, and two result files can be compared:
+
+    python -m benchmarks.suite --out before.json
+    python -m benchmarks.suite --n_samples 1000 100000 --n_dofs 2 100 --differentiator savgol --out after.json
+    python -m benchmarks.suite --compare before.json after.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from typing import List
+import numpy as np
+from benchmarks.synthetic import generate_case, synthetic_flags, synthetic_parameters, write_case
+from pipeline import (assemble_stage, build_parameters, differentiate_stage, load_stage, merge_settings, solve_stage,
+                      STAGES)
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+N_SAMPLES_GRID = [1000, 10000, 100000, 1000000, 10000000]
+N_DOFS_GRID = [2, 10, 100]
+POINT_KEYS = ['n_samples', 'n_dofs', 'topology', 'element_types', 'noise', 'differentiator', 'chunk_size']
+CHUNK_VALUES = 2 ** 23
+
+
+def auto_chunk_size(n_dofs: int, n_unknowns: int):
+    """
+    :returns: samples per chunk of the streaming assembly so a chunk of A (samples x dofs rows, unknowns columns) holds
+    about CHUNK_VALUES values.
+    """
+    return max(64, CHUNK_VALUES // (n_dofs * max(n_unknowns, 1)))
+
+
+def time_stages(responses_full_filenames: List[str], settings: dict):
+    """
+    Runs the stages of pipeline.run_stages one by one, without cache. Each stage runs twice: first under tracemalloc
+    for its peak memory, then timed with tracing off, since tracing slows down every allocation.
+
+    :returns: the solution of the solve stage, and dicts stage -> seconds and stage -> peak traced bytes.
+    """
+    settings = merge_settings(settings)
+    timings, peak_bytes = {}, {}
+
+    def measure(stage, func, *args):
+        tracemalloc.start()
+        func(*args)
+        peak_bytes[stage] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        t_ini = time.perf_counter()
+        output = func(*args)
+        timings[stage] = time.perf_counter() - t_ini
+        return output
+
+    t, x = measure('load', load_stage, responses_full_filenames, settings)
+    t, responses = measure('differentiate', differentiate_stage, t, x, settings)
+    parameters = build_parameters(settings)
+    system = measure('assemble', assemble_stage, t, responses, parameters, settings)
+    solution = measure('solve', solve_stage, system, parameters, settings)
+    timings['total'] = sum(timings[stage] for stage in STAGES)
+    return solution, timings, peak_bytes
+
+
+def recovery_errors(true_parameters: dict, identified_parameters: dict):
+    """
+    :returns: dict name -> |identified - true| / |true| of every unknown of true_parameters.
+    """
+    return {name: abs(identified_parameters['unknown'][name] - value) / abs(value)
+            for name, value in true_parameters['unknown'].items()}
+
+
+def run_point(point: dict):
+    """
+    Generates the synthetic case of point (a dict with POINT_KEYS, 'delta_t' and 'seed'), identifies it and measures
+    every stage. A chunk_size of None is sized by auto_chunk_size, 0 assembles the full A matrix.
+
+    :returns: point updated with the timings (s), peak_bytes, max_rss_bytes (whole process) and the recovery errors.
+    """
+    data_dir = tempfile.mkdtemp(prefix='sysid_benchmark_')
+    record = dict(point)
+    try:
+        t_ini = time.perf_counter()
+        true_parameters = synthetic_parameters(point['n_dofs'], point['topology'], point['element_types'],
+                                               point['seed'])
+        t, positions, noisy_positions = generate_case(true_parameters, point['n_samples'], point['delta_t'],
+                                                      noise=point['noise'], seed=point['seed'])
+        responses_full_filenames = write_case(data_dir, 'benchmark', t, positions, noisy_positions)
+        del t, positions, noisy_positions
+        generation_time = time.perf_counter() - t_ini
+        chunk_size = point['chunk_size']
+        if chunk_size is None:
+            chunk_size = auto_chunk_size(point['n_dofs'], len(true_parameters['unknown']))
+        record['chunk_size_used'] = chunk_size or None
+        settings = {'dof_masses': list(true_parameters['known'].values()),
+                    'flags': synthetic_flags(point['topology'], point['element_types']), 'use_smoothed': False,
+                    'max_disp': np.inf, 'differentiator': point['differentiator'], 'chunk_size': chunk_size or None}
+        solution, timings, peak_bytes = time_stages(responses_full_filenames, settings)
+        errors = recovery_errors(true_parameters, solution['par_result'])
+        record.update(status='ok', generation_time=generation_time, timings=timings, peak_bytes=peak_bytes,
+                      max_relative_error=max(errors.values()),
+                      median_relative_error=float(np.median(list(errors.values()))), relative_errors=errors,
+                      residual_rms=solution['residual_rms'].tolist())
+    except Exception as error:
+        record.update(status='failed', error=f'{type(error).__name__}: {error}')
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    if resource is not None:
+        # ru_maxrss is in kB on Linux and in bytes on macOS.
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        record['max_rss_bytes'] = max_rss if platform.system() == 'Darwin' else max_rss * 1024
+    return record
+
+
+def environment():
+    """
+    :returns: dict describing the machine, the interpreter, numpy and the git commit of the tree benchmarked.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit, 'python': platform.python_version(),
+            'numpy': np.__version__, 'platform': platform.platform(), 'processor': platform.processor(),
+            'cpu_count': os.cpu_count()}
+
+
+def grid_points(n_samples_list=N_SAMPLES_GRID, n_dofs_list=N_DOFS_GRID, topology: str = 'chain',
+                element_types=('k', 'c'), noise: float = 0., differentiator: str = 'central', chunk_size: int = None,
+                delta_t: float = 2e-3, seed: int = 0, max_values: float = 2e7):
+    """
+    :returns: the points to run and the ones skipped for having more than max_values samples x dofs.
+    """
+    points, skipped = [], []
+    for n_dofs in n_dofs_list:
+        for n_samples in n_samples_list:
+            point = {'n_samples': int(n_samples), 'n_dofs': int(n_dofs), 'topology': topology,
+                     'element_types': list(element_types), 'noise': noise, 'differentiator': differentiator,
+                     'chunk_size': chunk_size, 'delta_t': delta_t, 'seed': seed}
+            (points if n_samples * n_dofs <= max_values else skipped).append(point)
+    return points, skipped
+
+
+def run_suite(points: List[dict], out_filename: str = None, skipped: List[dict] = ()):
+    """
+    Runs every point in its own worker process, one at a time, printing a line per point and writing all the results
+    to out_filename (JSON) after each one.
+
+    :returns: dict with 'environment', 'results' and 'skipped'.
+    """
+    results = {'environment': environment(), 'results': [], 'skipped': list(skipped)}
+    print(f'{"n_samples":>10} {"n_dofs":>6} ' + ' '.join(f'{stage + " (s)":>16}' for stage in STAGES + ['total']) +
+          f' {"peak (MB)":>10} {"max error":>10}')
+    with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+        for record in pool.imap(run_point, points):
+            results['results'].append(record)
+            if record['status'] == 'ok':
+                print(f"{record['n_samples']:>10} {record['n_dofs']:>6} " +
+                      ' '.join(f"{record['timings'][stage]:>16.4f}" for stage in STAGES + ['total']) +
+                      f" {max(record['peak_bytes'].values()) / 2 ** 20:>10.1f} {record['max_relative_error']:>10.2e}")
+            else:
+                print(f"{record['n_samples']:>10} {record['n_dofs']:>6} {record['error']}")
+            if out_filename is not None:
+                with open(out_filename, 'w') as file:
+                    json.dump(results, file, indent=1)
+    return results
+
+
+def compare(before_filename: str, after_filename: str):
+    """
+    Prints the time and peak memory ratios (after / before) of every stage and the maximum recovery errors of the
+    points present in both result files.
+    """
+    with open(before_filename) as file:
+        before = json.load(file)
+    with open(after_filename) as file:
+        after = json.load(file)
+    for label, results in (('before', before), ('after', after)):
+        print(f"{label}: {results['environment']['commit']} ({results['environment']['time']})")
+
+    def key(record):
+        return tuple(json.dumps(record[name]) for name in POINT_KEYS)
+
+    before_records = {key(record): record for record in before['results'] if record['status'] == 'ok'}
+    print(f'{"n_samples":>10} {"n_dofs":>6} ' + ' '.join(f'{stage:>13}' for stage in STAGES + ['total']) +
+          f' {"peak ratio":>10} {"error before":>12} {"error after":>12}')
+    for record in after['results']:
+        if record['status'] != 'ok' or key(record) not in before_records:
+            continue
+        record_before = before_records[key(record)]
+        ratios = [record['timings'][stage] / record_before['timings'][stage] for stage in STAGES + ['total']]
+        peak_ratio = max(record['peak_bytes'].values()) / max(record_before['peak_bytes'].values())
+        errors = record_before['max_relative_error'], record['max_relative_error']
+        print(f"{record['n_samples']:>10} {record['n_dofs']:>6} " + ' '.join(f'{ratio:>12.2f}x' for ratio in ratios) +
+              f' {peak_ratio:>9.2f}x {errors[0]:>12.2e} {errors[1]:>12.2e}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n_samples', type=float, nargs='+', default=N_SAMPLES_GRID)
+    parser.add_argument('--n_dofs', type=int, nargs='+', default=N_DOFS_GRID)
+    parser.add_argument('--topology', choices=['chain', 'fully_connected'], default='chain')
+    parser.add_argument('--element_types', nargs='+', default=['k', 'c'])
+    parser.add_argument('--noise', type=float, default=0., help='noise standard deviation relative to the RMS')
+    parser.add_argument('--differentiator', default='central')
+    parser.add_argument('--chunk_size', type=int, default=None,
+                        help='samples per chunk of the streaming assembly (default: sized to the model), 0 to '
+                             'assemble the full A matrix')
+    parser.add_argument('--delta_t', type=float, default=2e-3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max_values', type=float, default=2e7, help='skip points with more samples x dofs')
+    parser.add_argument('--out', default='benchmark_results.json', help='JSON file of the results')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two JSON result files')
+    args = parser.parse_args()
+    if args.compare is not None:
+        compare(*args.compare)
+    else:
+        grid, skipped_points = grid_points(args.n_samples, args.n_dofs, args.topology, args.element_types, args.noise,
+                                           args.differentiator, args.chunk_size, args.delta_t, args.seed,
+                                           args.max_values)
+        if skipped_points:
+            print(f'{len(skipped_points)} points over --max_values skipped')
+        run_suite(grid, args.out, skipped_points)
@@ -0,0 +1,151 @@
+"""
+Synthetic test cases: free decays of lumped-mass models with known parameters, written as case_<case>_dof<i>_m.dat
+files in the pickle format of the tracked records, so they run through load_positions, pipeline.run_stages and
+batch.py like measured cases.
+
+Models with linear elements only (k, c, b) are computed in closed form by modal superposition, chunk by chunk, so long
+records cost no time stepping. Models with nonlinear elements (k2, k3, muN) are integrated with simulation.simulate.
+
+Run from the repository root:
+
+    python -m benchmarks.synthetic data/synthetic --n_dofs 5 --n_samples 100000 --element_types k c k3 --noise .01
+"""
+import argparse
+import os
+import pickle
+from typing import List
+import numpy as np
+from simulation import BatchedModel, simulate
+from utils import get_mck_mats, Parameters
+
+TOPOLOGIES = ['chain', 'fully_connected']
+LINEAR_ELEMENT_TYPES = ['k', 'c', 'b']
+# Ranges of the random values of each element type, around the ones identified on the bundled 2-dof records.
+ELEMENT_RANGES = {'k': (1.5e4, 2.5e4),
+                  'c': (10., 40.),
+                  'b': (.5, 2.),
+                  'k2': (-3e5, 3e5),
+                  'k3': (5e7, 2e8),
+                  'muN': (.5, 2.)}
+MASS_RANGE = (20., 35.)
+
+
+def synthetic_flags(topology: str = 'chain', element_types=('k', 'c')):
+    """
+    :returns: the flags of Parameters (and of pipeline settings) of a model with element_types connected as topology.
+    """
+    assert topology in TOPOLOGIES, f'Unsupported topology: {topology}'
+    flags = {'remove_mean': False}
+    for element_type in ELEMENT_RANGES:
+        flags[f'fully_connected_{element_type}'] = topology == 'fully_connected' and element_type in element_types
+        flags[f'chain_like_{element_type}'] = topology == 'chain' and element_type in element_types
+    return flags
+
+
+def synthetic_parameters(n_dofs: int, topology: str = 'chain', element_types=('k', 'c'), seed: int = 0):
+    """
+    Draws the masses and the element values of a model uniformly in MASS_RANGE and ELEMENT_RANGES.
+
+    :returns: parameters dict with the masses as known and the true values of the unknowns.
+    """
+    rng = np.random.default_rng(seed)
+    flags = synthetic_flags(topology, element_types)
+    dof_masses = rng.uniform(*MASS_RANGE, size=n_dofs).tolist()
+    parameters = Parameters(dof_masses=dof_masses, **{key: value for key, value in flags.items()
+                                                      if key != 'remove_mean'}).parameters
+    for name in parameters['unknown']:
+        parameters['unknown'][name] = float(rng.uniform(*ELEMENT_RANGES[name.split('_')[0]]))
+    return parameters
+
+
+def modal_free_response(parameters: dict, x_0: np.ndarray, x_dot_0: np.ndarray, delta_t: float, n_samples: int,
+                        chunk_size: int = 2 ** 16):
+    """
+    Exact free response of the linear model of parameters (elements k, c and b), as the superposition of the
+    eigenvectors of its state matrix.
+
+    :returns: positions (n_dofs x n_samples).
+    """
+    m_mat, c_mat, k_mat, b_mat = get_mck_mats(parameters, ret_b_mat=True)
+    n_dofs = m_mat.shape[0]
+    m_inv = np.linalg.inv(m_mat + b_mat)
+    state_mat = np.block([[np.zeros((n_dofs, n_dofs)), np.eye(n_dofs)],
+                          [- np.dot(m_inv, k_mat), - np.dot(m_inv, c_mat)]])
+    eig_vals, eig_vecs = np.linalg.eig(state_mat)
+    amplitudes = np.linalg.solve(eig_vecs, np.concatenate((x_0, x_dot_0)).astype(complex))
+    shapes = eig_vecs[:n_dofs] * amplitudes
+    positions = np.empty((n_dofs, n_samples))
+    for i_ini in range(0, n_samples, chunk_size):
+        t = np.arange(i_ini, min(i_ini + chunk_size, n_samples)) * delta_t
+        positions[:, i_ini:i_ini + t.shape[0]] = np.dot(shapes, np.exp(np.outer(eig_vals, t))).real
+    return positions
+
+
+def generate_case(parameters: dict, n_samples: int, delta_t: float = 2e-3, amplitude: float = .01,
+                  noise: float = 0., substeps: int = 4, seed: int = 0):
+    """
+    Free decay of the model of parameters from random initial positions of up to amplitude (m) and rest.
+
+    :param noise: Standard deviation of the white noise added to the positions of each dof, relative to their RMS.
+    :param substeps: Runge-Kutta 4 steps per sample, for models with nonlinear elements.
+    :returns: t (n_samples), the noiseless positions and the noisy ones (n_dofs x n_samples each).
+    """
+    rng = np.random.default_rng(seed)
+    n_dofs = len(parameters['known'])
+    x_0 = rng.uniform(- amplitude, amplitude, size=n_dofs)
+    x_dot_0 = np.zeros(n_dofs)
+    element_types = {name.split('_')[0] for name in parameters['unknown']}
+    if element_types <= set(LINEAR_ELEMENT_TYPES):
+        positions = modal_free_response(parameters, x_0, x_dot_0, delta_t, n_samples)
+    else:
+        _, positions, _ = simulate(BatchedModel(parameters), x_0, x_dot_0, delta_t, n_samples, substeps)
+        positions = positions[0].T.copy()
+    rms = np.sqrt(np.mean(positions ** 2, axis=1, keepdims=True))
+    noisy_positions = positions + noise * rms * rng.standard_normal(positions.shape)
+    return np.arange(n_samples) * delta_t, positions, noisy_positions
+
+
+def write_case(out_dir: str, case: str, t: np.ndarray, positions: np.ndarray, noisy_positions: np.ndarray):
+    """
+    Writes one case_<case>_dof<i>_m.dat per dof: a pickled list of three t/x/y arrays (n_samples x 3), the first two
+    (raw) with the noisy positions and the last one (smoothed) with the noiseless ones. y is 0.
+
+    :returns: list of the full filenames written, sorted by dof.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    full_filenames = []
+    for i_dof in range(positions.shape[0]):
+        raw = np.column_stack((t, noisy_positions[i_dof], np.zeros_like(t)))
+        smoothed = np.column_stack((t, positions[i_dof], np.zeros_like(t)))
+        full_filenames.append(os.path.join(out_dir, f'case_{case}_dof{i_dof + 1}_m.dat'))
+        with open(full_filenames[-1], 'wb') as file:
+            pickle.dump([raw, raw, smoothed], file, protocol=pickle.HIGHEST_PROTOCOL)
+    return full_filenames
+
+
+def main(out_dir: str, case: str = 'synthetic', n_dofs: int = 2, n_samples: int = 10000,
+         topology: str = 'chain', element_types: List[str] = ('k', 'c'), noise: float = 0., delta_t: float = 2e-3,
+         seed: int = 0):
+    parameters = synthetic_parameters(n_dofs, topology, element_types, seed)
+    t, positions, noisy_positions = generate_case(parameters, n_samples, delta_t, noise=noise, seed=seed)
+    full_filenames = write_case(out_dir, case, t, positions, noisy_positions)
+    with open(os.path.join(out_dir, f'case_{case}_parameters.pkl'), 'wb') as file:
+        pickle.dump(parameters, file)
+    print(f'{len(full_filenames)} files written to {out_dir}')
+    print(parameters)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('out_dir')
+    parser.add_argument('--case', default='synthetic')
+    parser.add_argument('--n_dofs', type=int, default=2)
+    parser.add_argument('--n_samples', type=int, default=10000)
+    parser.add_argument('--topology', choices=TOPOLOGIES, default='chain')
+    parser.add_argument('--element_types', nargs='+', choices=list(ELEMENT_RANGES), default=['k', 'c'])
+    parser.add_argument('--noise', type=float, default=0., help='noise standard deviation relative to the RMS')
+    parser.add_argument('--delta_t', type=float, default=2e-3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    main(args.out_dir, args.case, args.n_dofs, args.n_samples, args.topology, args.element_types, args.noise,
+         args.delta_t, args.seed)
@@ -0,0 +1,84 @@
+"""
+Block bootstrap of the identified parameters: percentile confidence intervals and covariance.
+
+The record is split in contiguous time blocks (long enough to hold the correlation of the residual, e.g. a few
+periods of the slowest mode) and the normal equations of each block are computed once. A replicate resamples the
+blocks with replacement, so it costs a weighted sum of the block Gram matrices and a p x p solve, with no pass over the
+samples. Replicates are solved in batches of batch_size, across processes.
+"""
+import os
+from typing import List
+import numpy as np
+from lumped_mass_sysid import get_block_normal_eqs, unknown_names
+from parallel import shared_pool, worker_shared
+from solvers import solve_gram_batch
+
+
+def _solve_replicates(task):
+    """
+    Solves a batch of n_replicates replicates drawn with seed_sequence from the block Grams shared by the pool.
+    """
+    seed_sequence, n_replicates = task
+    ata_blocks, atb_blocks = worker_shared()['ata'], worker_shared()['atb']
+    n_blocks = ata_blocks.shape[0]
+    weights = np.random.default_rng(seed_sequence).multinomial(n_blocks, np.full(n_blocks, 1 / n_blocks),
+                                                               size=n_replicates).astype(float)
+    return solve_gram_batch(np.einsum('rb,bpq->rpq', weights, ata_blocks),
+                            np.einsum('rb,bpq->rpq', weights, atb_blocks))[:, :, 0]
+
+
+def block_bootstrap(responses: List[dict], parameters: dict, dof_indexes: List[int], n_replicates: int = 2000,
+                    n_blocks: int = 50, confidence: float = .95, seed: int = 0, processes: int = None,
+                    batch_size: int = 500, chunk_size: int = 2 ** 14):
+    """
+    Block bootstrap of the unknowns of parameters (see the module docstring).
+
+    :param processes: Worker processes. By default, all the cores; 1 solves in this process.
+    :returns: dict with 'names' (of the unknowns), 'estimate' (fit to all the blocks), 'replicates' (n_replicates x
+    p), 'std', 'covariance' (p x p), 'intervals' (name -> (lower, upper) percentile bounds at confidence) and
+    'confidence'.
+    """
+    assert 0 < confidence < 1, 'confidence must be in (0, 1)'
+    assert n_blocks > 1, 'n_blocks must be at least 2'
+    ata_blocks, atb_blocks, _, _, elements = get_block_normal_eqs(responses, parameters, dof_indexes, n_blocks,
+                                                                  chunk_size)
+    names = unknown_names(parameters, elements)
+    estimate = solve_gram_batch(ata_blocks.sum(axis=0, keepdims=True), atb_blocks.sum(axis=0, keepdims=True))[0, :, 0]
+    # One seed per batch, so the replicates do not depend on the number of processes.
+    counts = [min(batch_size, n_replicates - i_ini) for i_ini in range(0, n_replicates, batch_size)]
+    tasks = list(zip(np.random.SeedSequence(seed).spawn(len(counts)), counts))
+    processes = min(os.cpu_count() if processes is None else processes, len(tasks))
+    with shared_pool({'ata': ata_blocks, 'atb': atb_blocks}, processes) as pool_map:
+        replicates = np.concatenate(list(pool_map(_solve_replicates, tasks,
+                                                  chunksize=int(np.ceil(len(tasks) / processes)))))
+    bounds = np.percentile(replicates, [50 * (1 - confidence), 50 * (1 + confidence)], axis=0)
+    return {'names': names, 'estimate': estimate, 'replicates': replicates, 'std': replicates.std(axis=0, ddof=1),
+            'covariance': np.cov(replicates, rowvar=False), 'confidence': confidence,
+            'intervals': {name: (bounds[0, i_name], bounds[1, i_name]) for i_name, name in enumerate(names)}}
+
+
+def replicate_parameters(bootstrap: dict, parameters: dict):
+    """
+    Yields a parameters dict per replicate of bootstrap, with the known values of parameters.
+    """
+    for gamma in bootstrap['replicates']:
+        yield {'known': parameters['known'], 'unknown': dict(zip(bootstrap['names'], gamma.tolist()))}
+
+
+def percentile_interval(values: np.ndarray, confidence: float):
+    """
+    :returns: lower and upper percentile bounds at confidence along the first axis of values (nan ignored).
+    """
+    return tuple(np.nanpercentile(values, [50 * (1 - confidence), 50 * (1 + confidence)], axis=0))
+
+
+def derived_intervals(bootstrap: dict, parameters: dict, func):
+    """
+    Percentile interval of a quantity derived from the parameters, e.g. damping ratios, at the confidence of
+    bootstrap.
+
+    :param func: function of a parameters dict returning a scalar or an array.
+    :returns: lower and upper bounds, with the shape of the output of func.
+    """
+    values = np.array([func(replicate) for replicate in replicate_parameters(bootstrap, parameters)])
+    return percentile_interval(values, bootstrap['confidence'])
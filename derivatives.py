@@ -0,0 +1,114 @@
+from functools import lru_cache
+import numpy as np
+
+DIFFERENTIATORS = ['diff', 'central', 'savgol', 'spectral']
+
+
+def check_differentiator(differentiator):
+    assert differentiator in DIFFERENTIATORS, f'Unsupported differentiator: {differentiator}'
+
+
+@lru_cache(maxsize=32)
+def savgol_coeffs(window: int, polyorder: int, delta_t: float):
+    """
+    Returns the Savitzky-Golay correlation coefficients (window x 3) that give position, velocity and acceleration at
+    the center of a window of samples, from the least squares fit of a polynomial of order polyorder.
+    """
+    assert window % 2 == 1 and window > polyorder >= 2, 'window must be odd and larger than polyorder >= 2'
+    offsets = np.arange(window) - window // 2
+    vandermonde = np.vander(offsets * delta_t, polyorder + 1, increasing=True)
+    fit = np.linalg.pinv(vandermonde)
+    coeffs = fit[:3].T * np.array([1, 1, 2])
+    coeffs.setflags(write=False)
+    return coeffs
+
+
+@lru_cache(maxsize=32)
+def _savgol_kernel_fft(window: int, polyorder: int, delta_t: float, n_fft: int):
+    kernels = savgol_coeffs(window, polyorder, delta_t)[::-1]
+    kernels_fft = np.fft.rfft(kernels, n=n_fft, axis=0).T
+    kernels_fft.setflags(write=False)
+    return kernels_fft
+
+
+@lru_cache(maxsize=32)
+def _spectral_multipliers(n_fft: int, delta_t: float, cutoff: float):
+    omega = 2 * np.pi * np.fft.rfftfreq(n_fft, delta_t)
+    multipliers = np.array([np.ones_like(omega), 1j * omega, - omega ** 2])
+    if cutoff is not None:
+        roll_off = np.clip((omega / (2 * np.pi * cutoff) - 1) / 0.25, 0, 1)
+        multipliers = multipliers * 0.5 * (1 + np.cos(np.pi * roll_off))
+    multipliers.setflags(write=False)
+    return multipliers
+
+
+def differentiated_range(n_samples: int, differentiator: str = 'diff', window: int = 11, **_):
+    """
+    Returns the first sample (i_start) and the number of samples of the output of differentiate for inputs of
+    n_samples samples. Takes the same settings as differentiate; only window matters.
+    """
+    check_differentiator(differentiator)
+    if differentiator == 'diff':
+        return 0, max(n_samples - 2, 0)
+    elif differentiator == 'central':
+        return 1, max(n_samples - 2, 0)
+    elif differentiator == 'savgol':
+        return window // 2, max(n_samples - window + 1, 0)
+    else:
+        return 0, n_samples
+
+
+def differentiate(x: np.ndarray, delta_t: float, differentiator: str = 'diff', window: int = 11, polyorder: int = 3,
+                  cutoff: float = None, fft_window: int = 25, out: np.ndarray = None):
+    """
+    Computes position, velocity and acceleration of all the dofs in one batched pass.
+
+    :param x: n_dofs x n_samples positions.
+    :param differentiator: 'diff' (forward differences, as get_responses always did), 'central' (central
+    differences), 'savgol' (Savitzky-Golay filter of window samples and polynomial order polyorder, which also smooths
+    the position) or 'spectral' (FFT of the mirrored record times i omega, low-passed from cutoff Hz
+    with a raised cosine roll-off over a quarter of it, if given).
+    :param fft_window: Savitzky-Golay windows longer than this are applied by FFT convolution.
+    :param out: Optional n_dofs x 3 x n_out array to write into (see differentiated_range).
+    :returns: n_dofs x 3 x n_out array, covering the input samples i_start:i_start + n_out of differentiated_range.
+    """
+    x = np.atleast_2d(x)
+    i_start, n_out = differentiated_range(x.shape[1], differentiator, window)
+    out = np.empty((x.shape[0], 3, n_out)) if out is None else out
+    assert out.shape == (x.shape[0], 3, n_out), f'out must have shape {(x.shape[0], 3, n_out)}'
+    if n_out == 0:
+        return out
+    if differentiator == 'diff':
+        out[:, 0] = x[:, :-2]
+        np.subtract(x[:, 1:-1], x[:, :-2], out=out[:, 1])
+        np.subtract(x[:, 2:], x[:, 1:-1], out=out[:, 2])
+        out[:, 2] -= out[:, 1]
+        out[:, 2] /= delta_t ** 2
+        out[:, 1] /= delta_t
+    elif differentiator == 'central':
+        out[:, 0] = x[:, 1:-1]
+        np.subtract(x[:, 2:], x[:, :-2], out=out[:, 1])
+        out[:, 1] /= 2 * delta_t
+        np.subtract(x[:, 2:], 2 * x[:, 1:-1], out=out[:, 2])
+        out[:, 2] += x[:, :-2]
+        out[:, 2] /= delta_t ** 2
+    elif differentiator == 'savgol' and window <= fft_window:
+        coeffs = savgol_coeffs(window, polyorder, float(delta_t))
+        np.multiply(coeffs[0].reshape((1, 3, 1)), x[:, np.newaxis, :n_out], out=out)
+        tmp = np.empty_like(out)
+        for i_tap in range(1, window):
+            np.multiply(coeffs[i_tap].reshape((1, 3, 1)), x[:, np.newaxis, i_tap:i_tap + n_out], out=tmp)
+            out += tmp
+    elif differentiator == 'savgol':
+        n_fft = 1 << int(np.ceil(np.log2(x.shape[1] + window - 1)))
+        kernels_fft = _savgol_kernel_fft(window, polyorder, float(delta_t), n_fft)
+        x_fft = np.fft.rfft(x, n=n_fft, axis=1)
+        for i_key, kernel_fft in enumerate(kernels_fft):
+            out[:, i_key] = np.fft.irfft(x_fft * kernel_fft, n=n_fft, axis=1)[:, window - 1:window - 1 + n_out]
+    else:
+        n_fft = 2 * x.shape[1]
+        x_fft = np.fft.rfft(np.concatenate((x, x[:, ::-1]), axis=1), axis=1)
+        multipliers = _spectral_multipliers(n_fft, float(delta_t), cutoff)
+        for i_key, multiplier in enumerate(multipliers):
+            out[:, i_key] = np.fft.irfft(x_fft * multiplier, n=n_fft, axis=1)[:, :n_out]
+    return out
@@ -0,0 +1,57 @@
+"""
+Bulk export of responses, one vectorized write per file instead of one print per sample.
+"""
+import json
+import os
+import numpy as np
+from responses import KEYS
+
+EXPORT_FORMATS = ['txt', 'csv', 'npz']
+
+
+def format_rows(values: np.ndarray, delimiter: str = ','):
+    """
+    Returns the text of values (n_rows x n_columns, or n_rows) with one row per line, every value in its shortest
+    repr (as print writes a float), formatted in a single pass.
+    """
+    values = np.asarray(values, dtype=float)
+    values = values.reshape((values.shape[0], -1))
+    row_format = delimiter.join(['%r'] * values.shape[1]) + '\n'
+    return (row_format * values.shape[0]) % tuple(values.ravel().tolist())
+
+
+def response_columns(responses):
+    return [f'{key}_{i_dof}' for i_dof in range(len(responses)) for key in KEYS]
+
+
+def export_responses(t: np.ndarray, responses, out_dir: str = '.', export_format: str = 'txt',
+                     basename: str = 'output'):
+    """
+    Writes t and every response of responses (Responses or list of dicts) to out_dir.
+
+    :param export_format: 'txt' (the former layout: <basename>_<i>.txt with the positions of dof i and
+    <basename>_time.txt, one value per line), 'csv' (<basename>.csv with t and every position, velocity and
+    acceleration as columns) or 'npz' (<basename>.npz with arrays t and data, n_dofs + 1 x 3 x n_samples, and the
+    column names).
+    :returns: list of the full filenames written.
+    """
+    assert export_format in EXPORT_FORMATS, f'Unsupported export_format: {export_format}'
+    os.makedirs(out_dir, exist_ok=True)
+    data = np.array([[response[key] for key in KEYS] for response in responses], dtype=float)
+    if export_format == 'txt':
+        full_filenames = [os.path.join(out_dir, f'{basename}_{i_dof}.txt') for i_dof in range(data.shape[0])]
+        for full_filename, x in zip(full_filenames, data[:, 0]):
+            with open(full_filename, 'w') as file:
+                file.write(format_rows(x))
+        full_filenames.append(os.path.join(out_dir, f'{basename}_time.txt'))
+        with open(full_filenames[-1], 'w') as file:
+            file.write(format_rows(t))
+    elif export_format == 'csv':
+        full_filenames = [os.path.join(out_dir, f'{basename}.csv')]
+        with open(full_filenames[0], 'w') as file:
+            file.write(','.join(['t'] + response_columns(responses)) + '\n')
+            file.write(format_rows(np.column_stack((t, data.reshape((-1, data.shape[2])).T))))
+    else:
+        full_filenames = [os.path.join(out_dir, f'{basename}.npz')]
+        np.savez(full_filenames[0], t=t, data=data, columns=json.dumps(response_columns(responses)))
+    return full_filenames
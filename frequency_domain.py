@@ -0,0 +1,104 @@
+"""
+Identification in the frequency domain, on a few spectral lines of the responses instead of every time sample.
+
+The positions are transformed once and the regressors of the linear elements follow from the position spectra X on
+the selected lines: k -> X, c -> i omega X and b -> - omega^2 X (no numerical differentiation of the records). k2 and
+k3 use the spectra of the time-domain columns and muN its describing function. Since the records are not periodic,
+the derivatives carry boundary terms a + i omega b per dof equation, identified as nuisance unknowns.
+"""
+from typing import List
+import numpy as np
+from lumped_mass_sysid import get_elements_assembly, set_unknowns
+from solvers import solve
+from utils import check_responses_integrity, ELEMENT_TYPES
+
+
+def select_lines(x_fft: np.ndarray, frequencies: np.ndarray, band=None, energy: float = None, max_lines: int = None):
+    """
+    Selects the spectral lines to fit: those within band (f_min, f_max) in Hz, reduced to the strongest ones holding
+    the fraction energy of the power of all the dofs in the band and to at most max_lines lines. The line at zero
+    frequency is always excluded.
+
+    :param x_fft: n_dofs x n_frequencies spectra.
+    :returns: indexes of the selected lines, in ascending frequency.
+    """
+    candidates = np.flatnonzero(frequencies > 0)
+    if band is not None:
+        candidates = candidates[(frequencies[candidates] >= band[0]) & (frequencies[candidates] <= band[1])]
+    assert candidates.size > 0, 'No spectral line in band'
+    power = np.sum(np.abs(x_fft[:, candidates]) ** 2, axis=0)
+    order = np.argsort(power)[::-1]
+    n_lines = candidates.size
+    if energy is not None:
+        assert 0 < energy <= 1, 'energy must be in (0, 1]'
+        n_lines = min(n_lines, int(np.searchsorted(np.cumsum(power[order]), energy * power.sum())) + 1)
+    if max_lines is not None:
+        n_lines = min(n_lines, max_lines)
+    return np.sort(candidates[order[:n_lines]])
+
+
+def element_spectra(element_type: str, x_fft: np.ndarray, x: np.ndarray, i: int, j: int, lines: np.ndarray,
+                    omega: np.ndarray):
+    """
+    Returns the regressor of an element between dofs i and j on lines (omega in rad/s), from the position spectra
+    x_fft and, for nonlinear elements, the positions x.
+    """
+    delta_x = x_fft[i, lines] - x_fft[j, lines]
+    if element_type == 'k':
+        return delta_x
+    elif element_type == 'c':
+        return 1j * omega * delta_x
+    elif element_type == 'b':
+        return - omega ** 2 * delta_x
+    elif element_type == 'k2':
+        return np.fft.rfft((x[i] - x[j]) ** 2)[lines]
+    elif element_type == 'k3':
+        return np.fft.rfft((x[i] - x[j]) ** 3)[lines]
+    else:
+        # First harmonic of sign(v) for v = V cos(omega t + phi) is 4 / pi cos(omega t + phi), whatever V.
+        delta_v = 1j * omega * delta_x
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(delta_v != 0, 2 * x.shape[1] / np.pi * delta_v / np.abs(delta_v), 0)
+
+
+def get_ab_mats_frequency(responses: List[dict], parameters: dict, dof_indexes: List[int], delta_t: float,
+                          band=None, energy: float = .99, max_lines: int = None, boundary_terms: bool = True,
+                          solve_and_ret: bool = False, solver: str = 'pinv', ret_report: bool = False):
+    """
+    Frequency-domain counterpart of get_ab_mats_assembly: one complex equation per dof and selected line (see
+    select_lines), stacked as real parts over imaginary parts. Only the positions of responses are used.
+
+    :param boundary_terms: Flag to add the nuisance columns 1 and i omega per dof, which absorb the boundary terms of
+    the derivatives of a non periodic record. They follow the element columns.
+    :returns: a_mat, b_mat, elements_assembly (the element of the first len(elements_assembly) columns) and
+    frequencies (Hz) of the selected lines. If solve_and_ret is True, gamma_mat (element unknowns only) and
+    par_result are also returned, followed by the report of the solver if ret_report is True.
+    """
+    n_samples = check_responses_integrity(responses)
+    x = np.array([response['x'] for response in responses], dtype=float)
+    x_fft = np.fft.rfft(x, axis=1)
+    frequencies = np.fft.rfftfreq(n_samples, delta_t)
+    lines = select_lines(x_fft[dof_indexes], frequencies, band, energy, max_lines)
+    omega = 2 * np.pi * frequencies[lines]
+    n_lines = lines.size
+    dofs, elements_assembly, dofs_columns = get_elements_assembly(responses, parameters, dof_indexes)
+    n_unknowns = len(elements_assembly)
+    a_mat = np.zeros((n_lines * len(dofs), n_unknowns + (2 * len(dofs) if boundary_terms else 0)), dtype=complex)
+    b_mat = np.empty((n_lines * len(dofs), 1), dtype=complex)
+    for i_dof, (dof, dof_columns) in enumerate(zip(dofs, dofs_columns)):
+        rows = slice(i_dof * n_lines, (i_dof + 1) * n_lines)
+        for element_type, j, column in zip(dof.element_types.tolist(), dof.element_js.tolist(), dof_columns):
+            a_mat[rows, column] = element_spectra(ELEMENT_TYPES[element_type], x_fft, x, dof.index, j, lines, omega)
+        if boundary_terms:
+            a_mat[rows, n_unknowns + 2 * i_dof] = 1
+            a_mat[rows, n_unknowns + 2 * i_dof + 1] = 1j * omega
+        b_mat[rows, 0] = dof.mass * omega ** 2 * x_fft[dof.index, lines]
+    a_mat, b_mat = np.vstack((a_mat.real, a_mat.imag)), np.vstack((b_mat.real, b_mat.imag))
+    if solve_and_ret:
+        gamma_mat, report = solve(a_mat, b_mat, solver=solver)
+        gamma_mat = gamma_mat[:n_unknowns]
+        par_result = set_unknowns(parameters, elements_assembly, gamma_mat)
+        results = a_mat, b_mat, elements_assembly, frequencies[lines], gamma_mat, par_result
+        return results + (report,) if ret_report else results
+    else:
+        return a_mat, b_mat, elements_assembly, frequencies[lines]
@@ -1,9 +1,13 @@
 from typing import List
 import numpy as np
-from utils import check_responses_integrity, check_element_type
+from utils import check_responses_integrity, ElementTable, ELEMENT_TYPES
+from solvers import solve, solve_gram
+from responses import Responses
 
 
 class Element:
+    __slots__ = ('element_type', 'i', 'j')
+
     def __init__(self, element_type: str, i: int, j: int):
         self.element_type = element_type
         self.i = i
@@ -20,29 +24,52 @@ class Element:
 
 
 class DOF:
-    def __init__(self, responses: List[np.ndarray], parameters: dict, index: int = 0):
+    def __init__(self, responses: List[np.ndarray], parameters: dict, index: int = 0,
+                 element_table: ElementTable = None):
         self.index = index
         self.mass = parameters['known'][f'm_{self.index}'] if self.index != 0 else 0
-        self.neighbors = []
         self.unknowns = parameters['unknown'].keys()
-        self.elements = []
-        for unknown in self.unknowns:
-            element_type, i, j = unknown.split('_')
-            i, j = int(i), int(j)
-            if i == self.index and j not in self.neighbors:
-                self.neighbors.append(j)
-            if j == self.index and i not in self.neighbors:
-                self.neighbors.append(i)
-            if i in self.neighbors and j == self.index:
-                self.elements.append(Element(element_type, i=self.index, j=i))
-            if j in self.neighbors and i == self.index:
-                self.elements.append(Element(element_type, i=self.index, j=j))
+        if element_table is None:
+            element_table = ElementTable.from_names(self.unknowns)
+        self.element_rows = element_table.incidence(self.index)
+        i, j = element_table.i[self.element_rows], element_table.j[self.element_rows]
+        self.element_types = element_table.types[self.element_rows]
+        self.element_js = np.where(i == self.index, j, i)
+        self.neighbors = list(dict.fromkeys(self.element_js.tolist()))
+        self._elements = None
+
+    @property
+    def elements(self):
+        if self._elements is None:
+            self._elements = [Element(ELEMENT_TYPES[element_type], i=self.index, j=j)
+                              for element_type, j in zip(self.element_types.tolist(), self.element_js.tolist())]
+        return self._elements
 
     def __str__(self):
         return f'dof_{self.index} ({[_.__str__() for _ in self.elements]})'
 
 
-def get_ab_mats(responses: List[np.ndarray], parameters: dict, dof_index: int, solve_and_ret: bool = False):
+def unknown_names(parameters: dict, elements: List[Element]):
+    """
+    Returns the key of parameters['unknown'] of each element, which may be either of its aliases.
+    """
+    return [element.__str__() if element.__str__() in parameters['unknown'].keys() else element.__str__(ji=True)
+            for element in elements]
+
+
+def set_unknowns(parameters: dict, elements: List[Element], gamma_mat: np.ndarray):
+    """
+    Returns a copy of parameters with the unknowns updated to the identified values in gamma_mat, whose rows follow
+    the order of elements.
+    """
+    par_result = {**parameters, 'unknown': dict(parameters['unknown'])}
+    for i_element, name in enumerate(unknown_names(parameters, elements)):
+        par_result['unknown'][name] = gamma_mat[i_element, 0]
+    return par_result
+
+
+def get_ab_mats(responses: List[np.ndarray], parameters: dict, dof_index: int, solve_and_ret: bool = False,
+                solver: str = 'pinv', ret_report: bool = False, element_table: ElementTable = None):
     """
     Returns the A and B matrices for system identification using Least Mean Squares on force summation on a known
     mass of a lumped mass system:
@@ -52,80 +79,209 @@ def get_ab_mats(responses: List[np.ndarray], parameters: dict, dof_index: int, s
     where gamma_mat is a column vector containing the values of the unknown parameters.
 
     :param solve_and_ret: Flag to ask to solve the System of Equations and return updated parameters
+    :param solver: Least squares backend used when solve_and_ret is True (see solvers.solve).
+    :param ret_report: Flag to also return the report (condition number and runtime) of the solver.
     :param dof_index: Index of dof to consider when assembling a_mat.
-    :param responses: List of dicts with np.ndarray. Dict keys must be 'x', 'x_dot' and 'x_ddot' for position,
-    velocity and acceleration, respectively. The first element in list [0] is the mass-irrelevant reference frame.
+    :param responses: Responses (see responses.py) or list of dicts with np.ndarray. Dict keys must be 'x', 'x_dot'
+    and 'x_ddot' for position, velocity and acceleration, respectively. The first element in list [0] is the
+    mass-irrelevant reference frame.
     :param parameters: Dict of 'known' and 'unknown' parameters of the
     system to identify. parameters['known'] must be 'm1', 'm2', and so on. parameters['unknown'] must be 'k_i_j' for
     stiffness, c_i_j for damping coefficient, k2_i_j for quadratic stiffness, k3_i_j for cubic stiffness, and muN_i_j
     for frictional dissipation between dof i and dof j.
+    :param element_table: ElementTable.from_names(parameters['unknown'].keys()), so callers assembling many dofs of
+    the same parameters parse the names of the unknowns only once. Built here if None.
     :returns: a_mat, b_mat np.ndarray s containing matrices A (a difference of
     responses in each column) and B (a column with the independent term). If ret_dof is True, a_mat, b_mat, dof are
     returned.
     """
-    dof = DOF(responses, parameters, index=dof_index)
+    dof = DOF(responses, parameters, index=dof_index, element_table=element_table)
     b_mat = - dof.mass * responses[dof_index]['x_ddot'].reshape((-1, 1))
-    a_columns = []
-    for element in dof.elements:
-        check_element_type(element.element_type)
-        assert dof.index == element.i
-        if element.element_type == 'k':
-            a_columns.append(responses[dof.index]['x'] - responses[element.j]['x'])
-        elif element.element_type == 'c':
-            a_columns.append(responses[dof.index]['x_dot'] - responses[element.j]['x_dot'])
-        elif element.element_type == 'b':
-            a_columns.append(responses[dof.index]['x_ddot'] - responses[element.j]['x_ddot'])
-        elif element.element_type == 'k2':
-            a_columns.append((responses[dof.index]['x'] - responses[element.j]['x'])**2)
-        elif element.element_type == 'k3':
-            a_columns.append((responses[dof.index]['x'] - responses[element.j]['x'])**3)
-        elif element.element_type == 'muN':
-            a_columns.append(np.sign(responses[dof.index]['x_dot'] - responses[element.j]['x_dot']))
-        else:
-            raise ValueError(f'Unsupported element type: {element.element_type} in {dof}')
-        a_columns[-1] = a_columns[-1].reshape(-1, 1)
-    a_mat = np.hstack(a_columns)
+    a_mat = np.empty((b_mat.shape[0], len(dof.elements)), order='F')
+    fill_element_columns(a_mat, responses, dof, columns=range(len(dof.elements)))
     if solve_and_ret:
-        gamma_mat = np.dot(np.linalg.pinv(a_mat), b_mat)
-        par_result = parameters.copy()
-        for i_element, element in enumerate(dof.elements):
-            if element.__str__() in par_result['unknown'].keys():
-                par_result['unknown'][element.__str__()] = gamma_mat[i_element, 0]
-            else:
-                par_result['unknown'][element.__str__(ji=True)] = gamma_mat[i_element, 0]
-        return a_mat, b_mat, dof, par_result
+        gamma_mat, report = solve(a_mat, b_mat, solver=solver)
+        par_result = set_unknowns(parameters, dof.elements, gamma_mat)
+        return (a_mat, b_mat, dof, par_result, report) if ret_report else (a_mat, b_mat, dof, par_result)
     else:
         return a_mat, b_mat, dof
 
 
+# Response each element type acts on and transformation applied to the relative response to build its column.
+COLUMN_BUILDERS = {'k': ('x', None),
+                   'c': ('x_dot', None),
+                   'b': ('x_ddot', None),
+                   'k2': ('x', np.square),
+                   'k3': ('x', lambda d, out: np.power(d, 3, out=out)),
+                   'muN': ('x_dot', np.sign)}
+
+
+def fill_element_columns(a_block: np.ndarray, responses: List[dict], dof: DOF, columns):
+    """
+    Writes in place the regressor column of each element of dof into a_block[:, columns[i_element]]. a_block is
+    expected to be Fortran ordered, so that each column is filled contiguously and without temporaries.
+    """
+    for element_type, j, column in zip(dof.element_types.tolist(), dof.element_js.tolist(), columns):
+        key, transform = COLUMN_BUILDERS[ELEMENT_TYPES[element_type]]
+        out = a_block[:, column]
+        np.subtract(responses[dof.index][key], responses[j][key], out=out)
+        if transform is not None:
+            transform(out, out=out)
+
+
+def get_elements_assembly(responses: List[dict], parameters: dict, dof_indexes: List[int]):
+    """
+    Resolves the elements of the assembled system once, before any numerics.
+
+    :returns: dofs (one DOF per index in dof_indexes), elements_assembly (one Element per unknown column, in the order
+    of first appearance) and dofs_columns (for each dof, the column of each of its elements).
+    """
+    element_table = ElementTable.from_names(parameters['unknown'].keys())
+    row_columns = np.full(len(element_table), -1)
+    dofs, elements_assembly, dofs_columns = [], [], []
+    for dof_index in dof_indexes:
+        dof = DOF(responses, parameters, index=dof_index, element_table=element_table)
+        is_new = row_columns[dof.element_rows] < 0
+        row_columns[dof.element_rows[is_new]] = np.arange(len(elements_assembly),
+                                                          len(elements_assembly) + np.count_nonzero(is_new))
+        elements_assembly.extend(Element(ELEMENT_TYPES[element_type], i=dof.index, j=j) for element_type, j in
+                                 zip(dof.element_types[is_new].tolist(), dof.element_js[is_new].tolist()))
+        dofs.append(dof)
+        dofs_columns.append(row_columns[dof.element_rows].tolist())
+    return dofs, elements_assembly, dofs_columns
+
+
 def get_ab_mats_assembly(responses: List[np.ndarray], parameters: dict, dof_indexes: List[int],
-                         solve_and_ret: bool = False):
+                         solve_and_ret: bool = False, solver: str = 'pinv', ret_report: bool = False,
+                         assembly: tuple = None):
+    """
+    Returns the A and B matrices of get_ab_mats stacked for all the dofs in dof_indexes, with the columns of elements
+    shared between dofs merged. The element to column map is resolved once and the matrices are allocated once and
+    filled in place, one block of n_samples rows per dof.
+
+    :param assembly: Output of get_elements_assembly for parameters and dof_indexes, so callers assembling many
+    chunks or blocks resolve the elements only once. Resolved here if None.
+
+    :returns: a_mat_assembly, b_mat_assembly and elements_assembly (the element of each column). If solve_and_ret is
+    True, gamma_mat_assembly and par_result_assembly are also returned, followed by the report of the solver if
+    ret_report is True.
+    """
     n_samples = check_responses_integrity(responses)
-    a_mat_assembly, b_mat_assembly, _ = get_ab_mats(responses, parameters, dof_indexes[0])
-    elements_assembly = _.elements
-    for i_dof, dof_index in enumerate(dof_indexes[1:], start=1):
-        a_mat_next, b_mat_next, dof_next = get_ab_mats(responses, parameters, dof_index)
-        b_mat_assembly = np.vstack((b_mat_assembly, b_mat_next))
-        a_mat_assembly = np.vstack((a_mat_assembly, np.zeros((n_samples, a_mat_assembly.shape[1]))))
-        for i_element_next, element_next in enumerate(dof_next.elements):
-            is_present = False
-            for i_element, element in enumerate(elements_assembly):
-                if element_next.is_same_as(element):
-                    a_mat_assembly[-n_samples:, i_element] = a_mat_next[:, i_element_next]
-                    is_present = True
-                    break
-            if not is_present:
-                a_mat_assembly = np.hstack((a_mat_assembly, np.zeros((n_samples * (1 + i_dof), 1))))
-                a_mat_assembly[-n_samples:, -1] = a_mat_next[:, i_element_next]
-                elements_assembly.append(element_next)
+    if assembly is None:
+        assembly = get_elements_assembly(responses, parameters, dof_indexes)
+    dofs, elements_assembly, dofs_columns = assembly
+    a_mat_assembly = np.zeros((n_samples * len(dofs), len(elements_assembly)), order='F')
+    b_mat_assembly = np.empty((n_samples * len(dofs), 1))
+    for i_dof, (dof, dof_columns) in enumerate(zip(dofs, dofs_columns)):
+        rows = slice(i_dof * n_samples, (i_dof + 1) * n_samples)
+        fill_element_columns(a_mat_assembly[rows], responses, dof, dof_columns)
+        np.multiply(- dof.mass, responses[dof.index]['x_ddot'], out=b_mat_assembly[rows, 0])
     if solve_and_ret:
-        gamma_mat_assembly = np.dot(np.linalg.pinv(a_mat_assembly), b_mat_assembly)
-        par_result_assembly = parameters.copy()
-        for i_element, element in enumerate(elements_assembly):
-            if element.__str__() in par_result_assembly['unknown'].keys():
-                par_result_assembly['unknown'][element.__str__()] = gamma_mat_assembly[i_element, 0]
-            else:
-                par_result_assembly['unknown'][element.__str__(ji=True)] = gamma_mat_assembly[i_element, 0]
-        return a_mat_assembly, b_mat_assembly, elements_assembly, gamma_mat_assembly, par_result_assembly
+        gamma_mat_assembly, report = solve(a_mat_assembly, b_mat_assembly, solver=solver)
+        par_result_assembly = set_unknowns(parameters, elements_assembly, gamma_mat_assembly)
+        results = a_mat_assembly, b_mat_assembly, elements_assembly, gamma_mat_assembly, par_result_assembly
+        return results + (report,) if ret_report else results
     else:
         return a_mat_assembly, b_mat_assembly, elements_assembly
+
+
+def slice_responses(responses: List[dict], i_ini: int = 0, i_fin: int = None):
+    """
+    Returns views of responses restricted to the samples i_ini:i_fin.
+    """
+    if isinstance(responses, Responses):
+        return responses.slice(i_ini, i_fin)
+    return [{key: response[key][i_ini:i_fin] for key in response.keys()} for response in responses]
+
+
+def get_normal_eqs_assembly(responses: List[dict], parameters: dict, dof_indexes: List[int],
+                            chunk_size: int = 2 ** 14, solve_and_ret: bool = False, solver: str = 'pinv',
+                            ret_report: bool = False, assembly: tuple = None):
+    """
+    Accumulates the normal equations of the system assembled by get_ab_mats_assembly reading the responses in chunks
+    of chunk_size samples, so the full A matrix is never built. Peak memory depends on chunk_size and on the number of
+    unknowns p, not on the length of the responses.
+
+    :param responses: Same as in get_ab_mats. Any sliceable 1D arrays are accepted (e.g. np.memmap).
+    :param chunk_size: Number of samples read per chunk.
+    :param solve_and_ret: Flag to ask to solve the normal equations and return updated parameters and residual RMS.
+    :param solver: 'pinv', 'cholesky' or 'ridge' (see solvers.solve_gram).
+    :param assembly: Same as in get_ab_mats_assembly. Resolved once for all the chunks if None.
+    :returns: ata_mats (n_dofs x p x p), atb_mats (n_dofs x p x 1) and btb_vals (n_dofs) with the contribution of each
+    dof in dof_indexes to A^T A, A^T b and b^T b, and elements_assembly. If solve_and_ret is True, gamma_mat_assembly,
+    par_result_assembly and residual_rms (one value per dof) are also returned, followed by the report of the solver
+    if ret_report is True.
+    """
+    n_samples = check_responses_integrity(responses)
+    assert chunk_size > 0, 'chunk_size must be positive'
+    if assembly is None:
+        assembly = get_elements_assembly(responses, parameters, dof_indexes)
+    elements_assembly = assembly[1]
+    n_unknowns = len(elements_assembly)
+    ata_mats = np.zeros((len(dof_indexes), n_unknowns, n_unknowns))
+    atb_mats = np.zeros((len(dof_indexes), n_unknowns, 1))
+    btb_vals = np.zeros(len(dof_indexes))
+    for i_ini in range(0, n_samples, chunk_size):
+        responses_chunk = slice_responses(responses, i_ini, i_ini + chunk_size)
+        a_mat_chunk, b_mat_chunk, _ = get_ab_mats_assembly(responses_chunk, parameters, dof_indexes,
+                                                           assembly=assembly)
+        n_chunk = b_mat_chunk.shape[0] // len(dof_indexes)
+        for i_dof in range(len(dof_indexes)):
+            a_block = a_mat_chunk[i_dof * n_chunk:(i_dof + 1) * n_chunk]
+            b_block = b_mat_chunk[i_dof * n_chunk:(i_dof + 1) * n_chunk]
+            ata_mats[i_dof] += np.dot(a_block.T, a_block)
+            atb_mats[i_dof] += np.dot(a_block.T, b_block)
+            btb_vals[i_dof] += np.dot(b_block[:, 0], b_block[:, 0])
+    if solve_and_ret:
+        gamma_mat_assembly, residual_rms, report = solve_normal_eqs(ata_mats, atb_mats, btb_vals, n_samples, solver)
+        par_result_assembly = set_unknowns(parameters, elements_assembly, gamma_mat_assembly)
+        results = ata_mats, atb_mats, btb_vals, elements_assembly, gamma_mat_assembly, par_result_assembly, residual_rms
+        return results + (report,) if ret_report else results
+    else:
+        return ata_mats, atb_mats, btb_vals, elements_assembly
+
+
+def get_block_normal_eqs(responses: List[dict], parameters: dict, dof_indexes: List[int], n_blocks: int,
+                         chunk_size: int = 2 ** 14):
+    """
+    Splits the responses in n_blocks contiguous blocks of samples and accumulates the normal equations of each block
+    (see get_normal_eqs_assembly), summed over the dofs, so resampling or cross validation over the blocks needs no
+    further pass over the samples.
+
+    :returns: ata_blocks (n_blocks x p x p), atb_blocks (n_blocks x p x 1), btb_blocks (n_blocks), n_rows_blocks
+    (n_blocks, rows of A in each block) and elements_assembly.
+    """
+    n_samples = check_responses_integrity(responses)
+    assert 0 < n_blocks <= n_samples, 'n_blocks must be between 1 and the number of samples'
+    edges = np.linspace(0, n_samples, n_blocks + 1).astype(int)
+    assembly = get_elements_assembly(responses, parameters, dof_indexes)
+    n_unknowns = len(assembly[1])
+    ata_blocks = np.empty((n_blocks, n_unknowns, n_unknowns))
+    atb_blocks = np.empty((n_blocks, n_unknowns, 1))
+    btb_blocks = np.empty(n_blocks)
+    for i_block in range(n_blocks):
+        ata_mats, atb_mats, btb_vals, _ = \
+            get_normal_eqs_assembly(slice_responses(responses, edges[i_block], edges[i_block + 1]), parameters,
+                                    dof_indexes, chunk_size=chunk_size, assembly=assembly)
+        ata_blocks[i_block] = ata_mats.sum(axis=0)
+        atb_blocks[i_block] = atb_mats.sum(axis=0)
+        btb_blocks[i_block] = btb_vals.sum()
+    return ata_blocks, atb_blocks, btb_blocks, np.diff(edges) * len(dof_indexes), assembly[1]
+
+
+def solve_normal_eqs(ata_mats: np.ndarray, atb_mats: np.ndarray, btb_vals: np.ndarray, n_samples: int,
+                     solver: str = 'pinv'):
+    """
+    Solves the least squares problem from the per dof normal equations returned by get_normal_eqs_assembly.
+    pinv(A^T A) A^T b equals pinv(A) b, so the result matches the one of get_ab_mats_assembly. Columns are scaled to
+    unit norm before the solve, since forming A^T A squares the condition number of A.
+
+    :returns: gamma_mat (p x 1), the RMS of the force residual on each dof and the report of the solver.
+    """
+    gamma_mat, report = solve_gram(ata_mats.sum(axis=0), atb_mats.sum(axis=0), solver=solver,
+                                   btb=btb_vals.sum(), n_rows=n_samples * len(btb_vals))
+    gamma = gamma_mat[:, 0]
+    residual_ss = btb_vals - 2 * np.einsum('p,dp->d', gamma, atb_mats[:, :, 0]) + \
+        np.einsum('p,dpq,q->d', gamma, ata_mats, gamma)
+    residual_rms = np.sqrt(np.maximum(residual_ss, 0) / n_samples)
+    return gamma_mat, residual_rms, report
@@ -1,9 +1,17 @@
 import os
 import pprint as pp
 import numpy as np
-from lumped_mass_sysid import get_ab_mats_assembly
-from myplots import plot_residuals, plot_responses, plot_fiting_chainlike
-from utils import get_responses, get_mck_mats, Parameters
+from bootstrap import block_bootstrap, percentile_interval, replicate_parameters
+from export import export_responses
+from modal import modal_analysis
+from pipeline import run_stages
+from stage_cache import StageCache
+from structure_search import search_structures
+from windowed_identification import sliding_window_identification, amplitude_binned_identification
+from myplots import plot_residuals, plot_responses, plot_fiting_chainlike, plot_parameter_trajectories, \
+    save_case_figures
+from simulation import simulation_error
+from utils import get_mck_mats, Parameters, t2delta_t
 import matplotlib.pyplot as plt
 
 case = '15'
@@ -13,7 +21,25 @@ response_filenames = [f'case_{case}_dof1_m.dat',
 use_smoothed = True
 i_ini, i_fin = 0, None
 max_disp = .015
+cache_dir = None  # folder of the memory-mapped response cache (see response_cache.py), None to unpickle every run
+differentiator = 'diff'  # 'diff', 'central', 'savgol' or 'spectral', see derivatives.py
+differentiator_settings = None  # e.g. {'window': 31, 'polyorder': 3} for 'savgol' or {'cutoff': 50} for 'spectral'
 dofs_indices = [1, 2]
+solver = 'pinv'  # 'lstsq', 'qr', 'cholesky', 'pinv' or 'ridge', see solvers.py
+search_structure = False  # rank candidate structures of search_element_types by BIC before the fit below
+search_element_types = ('k', 'c', 'k3', 'muN')
+window = None  # samples per moving window for parameter trajectories, None to skip
+n_amplitude_bins = None  # bins of relative displacement amplitude for parameter trajectories, None to skip
+domain = 'time'  # 'time' or 'frequency' (fit on the strongest spectral lines, see frequency_domain.py)
+frequency_band = None  # (f_min, f_max) in Hz of the lines fitted in the frequency domain, None for all
+frequency_energy = .99  # fraction of the power in frequency_band held by the lines fitted
+chunk_size = None  # samples per chunk for the streaming solve of long records, None assembles the full A matrix
+n_bootstrap = None  # block bootstrap replicates for confidence intervals (see bootstrap.py), None to skip
+simulate_fit = False  # re-integrate the identified model from the measured initial state (see simulation.py)
+stage_cache_dir = None  # folder of the on-disk cache of stage outputs (see stage_cache.py), None to recompute all
+stage_cache_bytes = 2 ** 30  # size over which the least recently used stage outputs are evicted
+export_format = 'txt'  # 'txt' (output_<i>.txt and output_time.txt), 'csv' or 'npz', see export.py; None to skip
+headless = False  # save every figure to figures/ instead of showing them (see myplots.save_case_figures)
 
 # Plot parameters
 d_lim = .003  # m
@@ -47,35 +73,76 @@ parameters = Parameters(dof_masses=dof_masses,
 print(parameters)
 
 if __name__ == '__main__':
-    #  Read responses assumed as positions
-    t, responses = get_responses(responses_full_filenames,
-                                 generate_referenceframe=True, remove_mean=flags['remove_mean'],
-                                 i_ini=i_ini, i_fin=i_fin, use_smoothed=use_smoothed, max_disp=max_disp)
-    plot_responses(t, responses)
-    for i, response in enumerate(responses):
-        file = open(f"output_{i}.txt", "w")
-        for item in response['x']:
-            print(item, file=file, flush=True)
-        file.close()
-        file = open(f"output_time.txt", "w")
-        for item in t:
-            print(item, file=file, flush=True)
-        file.close()
+    #  Read responses assumed as positions, differentiate, assemble and solve (cached stages if stage_cache_dir)
+    settings = {'dof_masses': dof_masses, 'flags': flags, 'use_smoothed': use_smoothed, 'i_ini': i_ini, 'i_fin': i_fin,
+                'max_disp': max_disp, 'cache_dir': cache_dir, 'differentiator': differentiator,
+                'differentiator_settings': differentiator_settings, 'domain': domain, 'frequency_band': frequency_band,
+                'frequency_energy': frequency_energy, 'solver': solver, 'chunk_size': chunk_size}
+    stage_cache = StageCache(stage_cache_dir, max_bytes=stage_cache_bytes) if stage_cache_dir is not None else None
+    outputs = run_stages(responses_full_filenames, settings, stage_cache)
+    t, responses, system, solution = outputs['t'], outputs['responses'], outputs['system'], outputs['solution']
+    parameters = outputs['parameters']
+    print(f"stage timings: {outputs['timings']}")
+    if export_format is not None:
+        export_responses(t, responses, export_format=export_format)
 
-    # Estimate parameters:
-    a_mat, b_mat, elements, gamma_mat, par_result = \
-        get_ab_mats_assembly(responses, parameters, dofs_indices, solve_and_ret=True)
+    # Rank candidate structures:
+    if search_structure:
+        structures_ranking, n_pruned = search_structures(responses, dof_masses, dofs_indices,
+                                                         element_types=search_element_types, criterion='bic')
+        print(f'*** Structure search ({len(structures_ranking)} solved, {n_pruned} pruned) ***')
+        for result in structures_ranking[:10]:
+            print(f" BIC={result['bic']:.1f}, holdout RMS={result['holdout_rms']:.3f}: {result['structure']}")
+
+    # Estimated parameters:
+    if domain == 'frequency':
+        frequencies = system['frequencies']
+        print(f'{len(frequencies)} spectral lines from {frequencies.min():.2f} to {frequencies.max():.2f} Hz')
+    a_mat, b_mat = (system['a_mat'], system['b_mat']) if domain == 'time' and chunk_size is None else (None, None)
+    gamma_mat, par_result = solution['gamma_mat'], solution['par_result']
+    solver_report, residual_rms = solution['solver_report'], solution['residual_rms']
+    print(f'{residual_rms=}')
+    print(f'{solver_report=}')
     pp.pprint(par_result)
+    if simulate_fit:
+        nrmse, _ = simulation_error(par_result, responses, dofs_indices, t2delta_t(t))
+        print(f'simulation NRMSE per dof = {nrmse[0]}')
     m_mat, c_mat, k_mat = get_mck_mats(par_result)
     print(f"{m_mat=}, \n {c_mat=}, \n {k_mat=}")
-    print("*** Raleigh hypothesis ***")
-    print(f" alpha damping = {c_mat / m_mat}")
-    print(f" beta damping = {c_mat / k_mat}")
+    modes = modal_analysis(par_result)
+    print(f" natural frequencies (Hz) = {modes['frequencies'][0]}")
+    print(f" modal damping ratios = {modes['damping_ratios'][0]}")
+    print("*** Rayleigh hypothesis (least squares fit of the modal damping ratios) ***")
+    print(f" alpha damping = {modes['alpha'][0]}")
+    print(f" beta damping = {modes['beta'][0]}")
+    if n_bootstrap is not None:
+        bootstrap = block_bootstrap(responses, parameters, dofs_indices, n_replicates=n_bootstrap)
+        print(f"*** Block bootstrap, {n_bootstrap} replicates, {bootstrap['confidence']:.0%} intervals ***")
+        for name, interval in bootstrap['intervals'].items():
+            print(f" {name}: [{interval[0]:.6g}, {interval[1]:.6g}]")
+        replicate_modes = modal_analysis(list(replicate_parameters(bootstrap, parameters)))
+        for key in ['frequencies', 'damping_ratios', 'alpha', 'beta']:
+            print(f" {key}: {percentile_interval(replicate_modes[key], bootstrap['confidence'])}")
 
-    # Plot residuals
-    plot_residuals(force_sum=np.dot(a_mat, gamma_mat).reshape((-1,)), inertia_term=b_mat.reshape((-1,)),
-                   dofs_indices=dofs_indices, t=t)
-    figs = plot_fiting_chainlike(responses=responses, parameters=parameters, d_lim=d_lim, fe_lim=fe_lim)
-    figs[0].savefig(f'case_{case}.pdf')
-    plt.show()
+    # Parameter trajectories
+    if window is not None:
+        trajectories = sliding_window_identification(responses, parameters, dofs_indices, window=window,
+                                                     step=max(1, window // 10), t=t)
+        plot_parameter_trajectories(trajectories['t'], trajectories)
+    if n_amplitude_bins is not None:
+        trajectories = amplitude_binned_identification(responses, parameters, dofs_indices, n_bins=n_amplitude_bins)
+        bin_centers = (trajectories['bin_edges'][1:] + trajectories['bin_edges'][:-1]) / 2
+        plot_parameter_trajectories(bin_centers, trajectories, xlabel='relative displacement amplitude (m)')
 
+    # Plot responses and residuals
+    if headless:
+        plt.switch_backend('Agg')
+        print(f"figures: {save_case_figures(outputs, 'figures', case, d_lim=d_lim, fe_lim=fe_lim)}")
+    else:
+        plot_responses(t, responses)
+        if a_mat is not None:
+            plot_residuals(force_sum=np.dot(a_mat, gamma_mat).reshape((-1,)), inertia_term=b_mat.reshape((-1,)),
+                           dofs_indices=dofs_indices, t=t)
+        figs = plot_fiting_chainlike(responses=responses, parameters=par_result, d_lim=d_lim, fe_lim=fe_lim)
+        figs[0].savefig(f'case_{case}.pdf')
+        plt.show()
@@ -0,0 +1,140 @@
+"""
+Modal analysis of the linear part of identified models (elements c, k and inerters b; nonlinear elements have no
+stiffness at equilibrium and are left out), batched over many parameter sets with the same number of dofs.
+
+Matrices are assembled in LAPACK upper banded storage, whose bandwidth is the largest |i - j| among the elements
+between two dofs (1 for chains), so the undamped eigenproblem of long chains is solved by scipy.linalg.eig_banded
+when scipy is installed. Otherwise, or when the matrices are not narrow banded, stacked dense np.linalg.eigh is used.
+"""
+from typing import List
+import numpy as np
+from utils import ELEMENT_TYPES, stack_parameters
+
+try:
+    from scipy.linalg import eig_banded
+except ImportError:
+    eig_banded = None
+
+EIGEN_SOLVERS = ['auto', 'banded', 'dense']
+
+
+def banded_mats(par_results: List[dict]):
+    """
+    Assembles the matrices of the elements c, k and b of every parameter set in upper banded storage: entry (i, j),
+    i <= j, of the matrix of set s is ab[s, u + i - j, j], u being the bandwidth.
+
+    :returns: masses (n_sets x n_dofs) and dict element type -> ab (n_sets x (u + 1) x n_dofs).
+    """
+    masses, table, values = stack_parameters(par_results)
+    n_sets, n_dofs = masses.shape
+    between_dofs = (table.i > 0) & (table.j > 0)
+    u = int(np.max(np.abs(table.i - table.j)[between_dofs])) if np.any(between_dofs) else 0
+    mats = {}
+    for element_type in ['c', 'k', 'b']:
+        rows = table.types == ELEMENT_TYPES.index(element_type)
+        ab = np.zeros((n_sets, u + 1, n_dofs))
+        for ends in (table.i[rows], table.j[rows]):
+            on_dof = ends > 0
+            np.add.at(ab, (slice(None), u, ends[on_dof] - 1), values[:, rows][:, on_dof])
+        coupled = between_dofs[rows]
+        lo = np.minimum(table.i[rows], table.j[rows])[coupled]
+        hi = np.maximum(table.i[rows], table.j[rows])[coupled]
+        np.add.at(ab, (slice(None), u - (hi - lo), hi - 1), - values[:, rows][:, coupled])
+        mats[element_type] = ab
+    return masses, mats
+
+
+def banded2dense(ab: np.ndarray):
+    """
+    Returns the symmetric dense matrices (n_sets x n_dofs x n_dofs) of the upper banded ab.
+    """
+    n_sets, n_bands, n_dofs = ab.shape
+    u = n_bands - 1
+    dense = np.zeros((n_sets, n_dofs, n_dofs))
+    for offset in range(n_bands):
+        columns = np.arange(offset, n_dofs)
+        dense[:, columns - offset, columns] = ab[:, u - offset, offset:]
+        dense[:, columns, columns - offset] = ab[:, u - offset, offset:]
+    return dense
+
+
+def banded_matmul(ab: np.ndarray, x: np.ndarray):
+    """
+    Returns the products (n_sets x n_dofs x n_columns) of the symmetric matrices in upper banded storage ab by x,
+    in O(bandwidth) operations per entry.
+    """
+    u = ab.shape[1] - 1
+    n_dofs = ab.shape[2]
+    product = ab[:, u, :, np.newaxis] * x
+    for offset in range(1, u + 1):
+        band = ab[:, u - offset, offset:, np.newaxis]
+        product[:, :n_dofs - offset] += band * x[:, offset:]
+        product[:, offset:] += band * x[:, :n_dofs - offset]
+    return product
+
+
+def rayleigh_fit(omegas: np.ndarray, damping_ratios: np.ndarray):
+    """
+    Least squares fit of the Rayleigh damping ratios zeta = alpha / (2 omega) + beta omega / 2 to the damping ratios
+    of every set. Modes with omega = 0 (rigid body) or nan are left out.
+
+    :returns: alpha and beta (n_sets each).
+    """
+    valid = (omegas > 0) & np.isfinite(damping_ratios)
+    safe_omegas = np.where(valid, omegas, 1)
+    design = np.stack((1 / (2 * safe_omegas), safe_omegas / 2), axis=-1) * valid[..., np.newaxis]
+    dtd = np.einsum('smi,smj->sij', design, design)
+    dtz = np.einsum('smi,sm->si', design, np.where(valid, damping_ratios, 0))
+    alpha_beta = np.matmul(np.linalg.pinv(dtd), dtz[:, :, np.newaxis])[:, :, 0]
+    return alpha_beta[:, 0], alpha_beta[:, 1]
+
+
+def modal_analysis(par_results: List[dict], eigen_solver: str = 'auto', n_rayleigh_modes: int = None):
+    """
+    Undamped natural frequencies and modes of every parameter set, modal damping ratios (zeta_r = phi_r^T C phi_r /
+    (2 omega_r) for mass normalized phi_r, exact for proportional damping) and the least squares Rayleigh fit.
+
+    :param eigen_solver: 'banded' (scipy.linalg.eig_banded, one set at a time), 'dense' (stacked np.linalg.eigh) or
+    'auto' (banded if scipy is installed, there are no inerters and the bandwidth is under a quarter of the dofs).
+    :param n_rayleigh_modes: Number of lowest modes the Rayleigh fit weights equally. By default, all of them.
+    :returns: dict with 'frequencies' (Hz), 'omegas' (rad/s) and 'damping_ratios' (n_sets x n_dofs, ascending),
+    'mode_shapes' (n_sets x n_dofs x n_dofs, mass normalized modes as columns), 'alpha' and 'beta' (n_sets).
+    """
+    assert eigen_solver in EIGEN_SOLVERS, f'Unsupported eigen_solver: {eigen_solver}'
+    masses, mats = banded_mats(par_results)
+    n_sets, n_dofs = masses.shape
+    u = mats['k'].shape[1] - 1
+    has_inerters = np.any(mats['b'])
+    if eigen_solver == 'auto':
+        eigen_solver = 'banded' if eig_banded is not None and not has_inerters and 4 * u < n_dofs else 'dense'
+    assert eigen_solver == 'dense' or eig_banded is not None, 'The banded eigen solver needs scipy'
+    assert eigen_solver == 'dense' or not has_inerters, 'Models with inerters need the dense eigen solver'
+    if has_inerters:
+        # K phi = omega^2 (M + B) phi, reduced to standard form with the Cholesky factor of M + B.
+        m_mats = banded2dense(mats['b'])
+        m_mats[:, np.arange(n_dofs), np.arange(n_dofs)] += masses
+        l_inv = np.linalg.inv(np.linalg.cholesky(m_mats))
+        eig_vals, eig_vecs = np.linalg.eigh(np.matmul(np.matmul(l_inv, banded2dense(mats['k'])),
+                                                      np.swapaxes(l_inv, 1, 2)))
+        mode_shapes = np.matmul(np.swapaxes(l_inv, 1, 2), eig_vecs)
+    else:
+        # K phi = omega^2 M phi with diagonal M: M^-1/2 K M^-1/2 keeps the band.
+        inv_sqrt_masses = 1 / np.sqrt(masses)
+        k_scaled = mats['k'].copy()
+        for offset in range(u + 1):
+            k_scaled[:, u - offset, offset:] *= inv_sqrt_masses[:, :n_dofs - offset] * inv_sqrt_masses[:, offset:]
+        if eigen_solver == 'banded':
+            eig_vals, eig_vecs = np.empty((n_sets, n_dofs)), np.empty((n_sets, n_dofs, n_dofs))
+            for i_set in range(n_sets):
+                eig_vals[i_set], eig_vecs[i_set] = eig_banded(k_scaled[i_set], lower=False)
+        else:
+            eig_vals, eig_vecs = np.linalg.eigh(banded2dense(k_scaled))
+        mode_shapes = inv_sqrt_masses[:, :, np.newaxis] * eig_vecs
+    omegas = np.sqrt(np.maximum(eig_vals, 0))
+    modal_damping = np.sum(mode_shapes * banded_matmul(mats['c'], mode_shapes), axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        damping_ratios = np.where(omegas > 0, modal_damping / (2 * omegas), np.nan)
+    n_rayleigh_modes = n_dofs if n_rayleigh_modes is None else n_rayleigh_modes
+    alpha, beta = rayleigh_fit(omegas[:, :n_rayleigh_modes], damping_ratios[:, :n_rayleigh_modes])
+    return {'frequencies': omegas / (2 * np.pi), 'omegas': omegas, 'damping_ratios': damping_ratios,
+            'mode_shapes': mode_shapes, 'alpha': alpha, 'beta': beta}
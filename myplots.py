@@ -1,8 +1,47 @@
+import os
 from typing import List
 import numpy as np
 from matplotlib import pyplot as plt
 
 
+def envelope_decimate(x: np.ndarray, y: np.ndarray, n_bins: int):
+    """
+    Reduces a series to the minimum and the maximum of y on each of n_bins consecutive groups of samples, in sample
+    order, which draws the same as the full series when n_bins is the pixel width of the axes. x must be sorted.
+    Series of up to 4 n_bins samples are returned as they are.
+    """
+    n_samples = y.shape[0]
+    if n_bins < 1 or n_samples <= 4 * n_bins:
+        return x, y
+    bin_size = int(np.ceil(n_samples / n_bins))
+    n_full = n_samples // bin_size * bin_size
+    starts = np.arange(0, n_full, bin_size)
+    groups = y[:n_full].reshape((-1, bin_size))
+    indexes = np.stack((starts + np.argmin(groups, axis=1), starts + np.argmax(groups, axis=1)), axis=1)
+    indexes.sort(axis=1)
+    indexes = indexes.ravel()
+    if n_full < n_samples:
+        rest = y[n_full:]
+        indexes = np.concatenate((indexes, np.sort([n_full + np.argmin(rest), n_full + np.argmax(rest)])))
+    return x[indexes], y[indexes]
+
+
+def axes_pixel_width(ax):
+    return int(np.ceil(ax.get_window_extent().width))
+
+
+def plot_decimated(ax, x: np.ndarray, y: np.ndarray, sort_x: bool = False, **kwargs):
+    """
+    ax.plot of the min/max envelope of y on as many bins as ax is wide in pixels (see envelope_decimate).
+
+    :param sort_x: Flag to sort the samples by x first, for curves of y as a function of x (not of time).
+    """
+    if sort_x:
+        order = np.argsort(x, kind='stable')
+        x, y = x[order], y[order]
+    return ax.plot(*envelope_decimate(np.asarray(x), np.asarray(y), axes_pixel_width(ax)), **kwargs)
+
+
 def plot_responses(t: np.ndarray, responses: List[np.ndarray]):
     fig, axs = plt.subplots(len(responses), 3, sharex='all')
     axs[0, 0].set_title('displacement (m)')
@@ -10,9 +49,9 @@ def plot_responses(t: np.ndarray, responses: List[np.ndarray]):
     axs[0, 2].set_title('acceleration (m/s2)')
     for i, response in enumerate(responses):
         axs[i, 0].set_ylabel(f'DOF {i}')
-        axs[i, 0].plot(t, response['x'])
-        axs[i, 1].plot(t, response['x_dot'])
-        axs[i, 2].plot(t, response['x_ddot'])
+        plot_decimated(axs[i, 0], t, response['x'])
+        plot_decimated(axs[i, 1], t, response['x_dot'])
+        plot_decimated(axs[i, 2], t, response['x_ddot'])
     [axs[-1, col].set_xlabel('time (s)') for col in range(3)]
     return fig, axs
 
@@ -27,11 +66,11 @@ def plot_residuals(force_sum: np.ndarray, inertia_term: np.ndarray, dofs_indices
         axs = [axs]
     i = 0
     for i in range(len(dofs_indices)):
-        axs[i].plot(t_, force_sum[i * len(t_):(i + 1) * len(t_)], label='sum of forces')
-        axs[i].plot(t_, inertia_term[i * len(t_):(i + 1) * len(t_)], label='inertial term')
+        plot_decimated(axs[i], t_, force_sum[i * len(t_):(i + 1) * len(t_)], label='sum of forces')
+        plot_decimated(axs[i], t_, inertia_term[i * len(t_):(i + 1) * len(t_)], label='inertial term')
         axs[i].set_ylabel(f'force (N) on DOF {dofs_indices[i]}')
         error = (force_sum - inertia_term)[i * len(t_):(i + 1) * len(t_)]
-        axs[i].plot(t_, error, label=f'error RMS={np.round(np.sqrt(np.mean(error ** 2)), 2)}')
+        plot_decimated(axs[i], t_, error, label=f'error RMS={np.round(np.sqrt(np.mean(error ** 2)), 2)}')
         axs[i].legend()
     if t is None:
         axs[i].set_xlabel('time (samples)')
@@ -61,10 +100,10 @@ def plot_fiting_chainlike(responses: list, parameters: dict, d_lim=0, v_lim=0, f
         except KeyError:
             elastic_force_cubic = displacements * 0
         elastic_force_total = elastic_force_linear + elastic_force_quadratic + elastic_force_cubic
-        axs[i].plot(displacements, elastic_force_total, label='total', linewidth=2)
-        axs[i].plot(displacements, elastic_force_linear, label='linear', linewidth=0.5)
-        axs[i].plot(displacements, elastic_force_quadratic, label='quadratic', linewidth=0.5)
-        axs[i].plot(displacements, elastic_force_cubic, label='cubic', linewidth=0.5)
+        plot_decimated(axs[i], displacements, elastic_force_total, sort_x=True, label='total', linewidth=2)
+        plot_decimated(axs[i], displacements, elastic_force_linear, sort_x=True, label='linear', linewidth=0.5)
+        plot_decimated(axs[i], displacements, elastic_force_quadratic, sort_x=True, label='quadratic', linewidth=0.5)
+        plot_decimated(axs[i], displacements, elastic_force_cubic, sort_x=True, label='cubic', linewidth=0.5)
         axs[i].tick_params(axis='both', which='both')
         axs[i].grid('both')
         if d_lim > 0:
@@ -90,9 +129,9 @@ def plot_fiting_chainlike(responses: list, parameters: dict, d_lim=0, v_lim=0, f
         except KeyError:
             dissipative_force_frictional = velocities * 0
         dissipative_force_total = dissipative_force_linear + dissipative_force_frictional
-        axs[i].plot(velocities, dissipative_force_total, label='total', linewidth=2)
-        axs[i].plot(velocities, dissipative_force_linear, label='linear', linewidth=0.5)
-        axs[i].plot(velocities, dissipative_force_frictional, label='frictional', linewidth=0.5)
+        plot_decimated(axs[i], velocities, dissipative_force_total, sort_x=True, label='total', linewidth=2)
+        plot_decimated(axs[i], velocities, dissipative_force_linear, sort_x=True, label='linear', linewidth=0.5)
+        plot_decimated(axs[i], velocities, dissipative_force_frictional, sort_x=True, label='frictional', linewidth=0.5)
         axs[i].tick_params(axis='both', which='both')
         axs[i].grid('both')
         if v_lim > 0:
@@ -101,3 +140,43 @@ def plot_fiting_chainlike(responses: list, parameters: dict, d_lim=0, v_lim=0, f
     plt.tight_layout()
     figs.append(fig)
     return figs
+
+
+def plot_parameter_trajectories(x: np.ndarray, trajectories: dict, xlabel: str = 'time (s)'):
+    names = list(trajectories['unknown'].keys())
+    fig, axs = plt.subplots(len(names) + 1, 1, sharex='all')
+    for ax, name in zip(axs, names):
+        ax.plot(x, trajectories['unknown'][name], marker='.' if len(x) < 100 else None)
+        ax.set_ylabel(name)
+        ax.grid('both')
+    axs[-1].plot(x, trajectories['residual_rms'], marker='.' if len(x) < 100 else None)
+    axs[-1].set_ylabel('residual RMS (N)')
+    axs[-1].set_xlabel(xlabel)
+    return fig, axs
+
+
+def save_case_figures(outputs: dict, out_dir: str, case: str, file_format: str = 'png', d_lim=0, v_lim=0, fe_lim=0):
+    """
+    Renders the figures of one case (responses, force residuals when the full time-domain system was assembled, and
+    the chain-like fitting) from the outputs of pipeline.run_stages, writes them to out_dir and closes them. Meant to
+    run headless, e.g. in batch workers after plt.switch_backend('Agg').
+
+    :returns: list of the full filenames written.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    t, responses, system, solution = outputs['t'], outputs['responses'], outputs['system'], outputs['solution']
+    figs = {'responses': plot_responses(t, responses)[0]}
+    if 'a_mat' in system and 'frequencies' not in system:
+        dofs_indices = list(range(1, len(responses)))
+        figs['residuals'] = plot_residuals(force_sum=np.dot(system['a_mat'], solution['gamma_mat']).reshape((-1,)),
+                                           inertia_term=system['b_mat'].reshape((-1,)), dofs_indices=dofs_indices,
+                                           t=t)[0]
+    if len(responses) > 2:
+        figs['elastic'], figs['dissipative'] = plot_fiting_chainlike(responses, solution['par_result'], d_lim=d_lim,
+                                                                     v_lim=v_lim, fe_lim=fe_lim)
+    full_filenames = []
+    for name, fig in figs.items():
+        full_filenames.append(os.path.join(out_dir, f'case_{case}_{name}.{file_format}'))
+        fig.savefig(full_filenames[-1])
+        plt.close(fig)
+    return full_filenames
@@ -0,0 +1,33 @@
+"""
+Process pools whose workers hold read-only arrays sent once, on start, instead of with every task.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+_worker_shared = {}
+
+
+def _init_worker(shared: dict):
+    _worker_shared.clear()
+    _worker_shared.update(shared)
+
+
+def worker_shared():
+    """
+    :returns: the shared dict of the pool (see shared_pool) of the current worker, or of this process.
+    """
+    return _worker_shared
+
+
+@contextmanager
+def shared_pool(shared: dict, processes: int = 1):
+    """
+    Context manager yielding a map(func, tasks, chunksize=1) that runs func in processes worker processes, each
+    initialized with shared (read by func with worker_shared). With processes 1, tasks run in this process.
+    """
+    _init_worker(shared)
+    if processes > 1:
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(shared,)) as executor:
+            yield executor.map
+    else:
+        yield lambda func, tasks, chunksize=1: map(func, tasks)
@@ -0,0 +1,183 @@
+"""
+Identification of one case as explicit stages: load -> differentiate -> assemble -> solve, driven by a settings dict
+(see DEFAULT_SETTINGS) so the same case runs identically from main.py, batch.py or a worker process.
+"""
+import time
+from typing import List
+import numpy as np
+from frequency_domain import get_ab_mats_frequency
+from lumped_mass_sysid import get_ab_mats_assembly, get_normal_eqs_assembly, set_unknowns, solve_normal_eqs
+from solvers import solve
+from stage_cache import settings_hash
+from utils import load_positions, positions2responses, t2delta_t, Parameters
+
+STAGES = ['load', 'differentiate', 'assemble', 'solve']
+
+DEFAULT_SETTINGS = {'dof_masses': [32.37, 26.007],
+                    'flags': {'remove_mean': True,
+                              'fully_connected_k': False, 'chain_like_k': True,
+                              'fully_connected_k2': False, 'chain_like_k2': False,
+                              'fully_connected_k3': False, 'chain_like_k3': False,
+                              'fully_connected_c': True, 'chain_like_c': False,
+                              'fully_connected_muN': False, 'chain_like_muN': False,
+                              'fully_connected_b': False, 'chain_like_b': False},
+                    'use_smoothed': True,
+                    'i_ini': 0,
+                    'i_fin': None,
+                    'max_disp': .015,
+                    'cache_dir': None,
+                    'differentiator': 'diff',
+                    'differentiator_settings': None,
+                    'domain': 'time',
+                    'frequency_band': None,
+                    'frequency_energy': .99,
+                    'solver': 'pinv',
+                    'chunk_size': None}
+
+
+def merge_settings(settings: dict = None):
+    """
+    Returns DEFAULT_SETTINGS updated with settings (flags are updated key by key).
+    """
+    merged = dict(DEFAULT_SETTINGS, flags=dict(DEFAULT_SETTINGS['flags']))
+    for key, value in (settings or {}).items():
+        assert key in DEFAULT_SETTINGS, f'Unknown setting: {key}'
+        if key == 'flags':
+            merged['flags'].update(value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def build_parameters(settings: dict):
+    flags = {key: value for key, value in settings['flags'].items() if key != 'remove_mean'}
+    return Parameters(dof_masses=settings['dof_masses'], **flags).parameters
+
+
+def load_stage(responses_full_filenames: List[str], settings: dict):
+    return load_positions(responses_full_filenames, settings['flags']['remove_mean'], settings['i_ini'],
+                          settings['i_fin'], settings['use_smoothed'], settings['max_disp'], settings['cache_dir'])
+
+
+def differentiate_stage(t: np.ndarray, x: np.ndarray, settings: dict):
+    return positions2responses(t, x, True, settings['differentiator'], settings['differentiator_settings'])
+
+
+def assemble_stage(t: np.ndarray, responses, parameters: dict, settings: dict):
+    """
+    :returns: dict with the system of the chosen domain: 'a_mat', 'b_mat' and 'elements' for the full time-domain
+    assembly or the frequency domain (plus 'frequencies'), or the per dof normal equations 'ata_mats', 'atb_mats',
+    'btb_vals' and 'elements' when chunk_size is set.
+    """
+    dof_indexes = list(range(1, len(settings['dof_masses']) + 1))
+    if settings['domain'] == 'frequency':
+        a_mat, b_mat, elements, frequencies = \
+            get_ab_mats_frequency(responses, parameters, dof_indexes, t2delta_t(t), band=settings['frequency_band'],
+                                  energy=settings['frequency_energy'])
+        return {'a_mat': a_mat, 'b_mat': b_mat, 'elements': elements, 'frequencies': frequencies}
+    elif settings['chunk_size'] is None:
+        a_mat, b_mat, elements = get_ab_mats_assembly(responses, parameters, dof_indexes)
+        return {'a_mat': a_mat, 'b_mat': b_mat, 'elements': elements}
+    else:
+        ata_mats, atb_mats, btb_vals, elements = \
+            get_normal_eqs_assembly(responses, parameters, dof_indexes, chunk_size=settings['chunk_size'])
+        return {'ata_mats': ata_mats, 'atb_mats': atb_mats, 'btb_vals': btb_vals, 'elements': elements,
+                'n_samples': responses.n_samples}
+
+
+def solve_stage(system: dict, parameters: dict, settings: dict):
+    """
+    :returns: dict with 'gamma_mat', 'par_result', 'residual_rms' (RMS of the force residual per dof, over the rows
+    of the system) and 'solver_report'.
+    """
+    n_dofs = len(settings['dof_masses'])
+    if 'a_mat' in system:
+        gamma_mat, report = solve(system['a_mat'], system['b_mat'], solver=settings['solver'])
+        # Rows are blocks per dof, repeated for real and imaginary parts in the frequency domain.
+        n_parts = 2 if settings['domain'] == 'frequency' else 1
+        residuals = (np.dot(system['a_mat'], gamma_mat) - system['b_mat']).reshape((n_parts, n_dofs, -1))
+        residual_rms = np.sqrt(np.mean(residuals ** 2, axis=(0, 2)))
+        gamma_mat = gamma_mat[:len(system['elements'])]
+    else:
+        gamma_mat, residual_rms, report = solve_normal_eqs(system['ata_mats'], system['atb_mats'],
+                                                           system['btb_vals'], system['n_samples'],
+                                                           solver=settings['solver'])
+    par_result = set_unknowns(parameters, system['elements'], gamma_mat)
+    return {'gamma_mat': gamma_mat, 'par_result': par_result, 'residual_rms': residual_rms, 'solver_report': report}
+
+
+def stage_settings(stage: str, settings: dict):
+    """
+    Returns the settings stage depends on, which key its cached output along with the key of the stage upstream.
+    """
+    if stage == 'load':
+        return {'remove_mean': settings['flags']['remove_mean'], 'i_ini': settings['i_ini'], 'i_fin': settings['i_fin'],
+                'use_smoothed': settings['use_smoothed'], 'max_disp': settings['max_disp']}
+    elif stage == 'differentiate':
+        return {'differentiator': settings['differentiator'],
+                'differentiator_settings': settings['differentiator_settings']}
+    elif stage == 'assemble':
+        return {'dof_masses': list(settings['dof_masses']),
+                'flags': {key: value for key, value in settings['flags'].items() if key != 'remove_mean'},
+                'domain': settings['domain'], 'frequency_band': settings['frequency_band'],
+                'frequency_energy': settings['frequency_energy'], 'chunk_size': settings['chunk_size']}
+    else:
+        return {'solver': settings['solver']}
+
+
+def run_stages(responses_full_filenames: List[str], settings: dict = None, stage_cache=None):
+    """
+    Runs all the stages for one case, through stage_cache (a stage_cache.StageCache) if given.
+
+    :returns: dict with the outputs 't', 'responses', 'parameters', 'system' (see assemble_stage) and 'solution' (see
+    solve_stage), and 'timings' (seconds per stage and 'total').
+    """
+    settings = merge_settings(settings)
+
+    def run(stage, key, func, *args):
+        if stage_cache is None:
+            return func(*args)
+        return stage_cache.memoize(stage, key, func, *args)
+
+    timings = {}
+    t_ini = time.perf_counter()
+    keys, key = {}, stage_cache.files_key(responses_full_filenames) if stage_cache is not None else None
+    for stage in STAGES:
+        if key is not None:
+            key = settings_hash(stage, key, stage_settings(stage, settings))
+        keys[stage] = key
+    t, x = run('load', keys['load'], load_stage, responses_full_filenames, settings)
+    timings['load'] = time.perf_counter() - t_ini
+    t_stage = time.perf_counter()
+    t, responses = run('differentiate', keys['differentiate'], differentiate_stage, t, x, settings)
+    timings['differentiate'] = time.perf_counter() - t_stage
+    t_stage = time.perf_counter()
+    parameters = build_parameters(settings)
+    system = run('assemble', keys['assemble'], assemble_stage, t, responses, parameters, settings)
+    timings['assemble'] = time.perf_counter() - t_stage
+    t_stage = time.perf_counter()
+    solution = run('solve', keys['solve'], solve_stage, system, parameters, settings)
+    timings['solve'] = time.perf_counter() - t_stage
+    timings['total'] = time.perf_counter() - t_ini
+    return {'t': t, 'responses': responses, 'parameters': solution['par_result'], 'system': system,
+            'solution': solution, 'timings': timings}
+
+
+def run_case(responses_full_filenames: List[str], settings: dict = None, stage_cache=None):
+    """
+    Runs all the stages for one case (see run_stages) and keeps the summary of the results.
+
+    :returns: dict with 'n_samples', 'unknown' (identified parameters), 'residual_rms' (per dof), 'solver_report'
+    and 'timings' (seconds per stage and 'total').
+    """
+    return case_summary(run_stages(responses_full_filenames, settings, stage_cache))
+
+
+def case_summary(outputs: dict):
+    """
+    :returns: the summary of run_case from the outputs of run_stages.
+    """
+    solution = outputs['solution']
+    return {'n_samples': outputs['responses'].n_samples, 'unknown': dict(solution['par_result']['unknown']),
+            'residual_rms': solution['residual_rms'].tolist(), 'solver_report': solution['solver_report'],
+            'timings': outputs['timings']}
@@ -0,0 +1,102 @@
+"""
+Memory-mapped cache of the pickled t/x/y responses read by utils.get_responses.
+
+Each source file is converted once to one .npy file per array of its pickled list, stored column by column so that
+a window of one column is paged in alone, plus a small JSON sidecar. Files are keyed by the hash of the source
+content; a per-source record of size and modification time avoids hashing again unchanged sources.
+
+Conversion of a campaign ahead of time:
+
+    python response_cache.py cache_dir case_*_dof*_m.dat
+"""
+import glob
+import hashlib
+import json
+import os
+import pickle
+import sys
+import numpy as np
+
+VARIANTS = {'raw': 1, 'smoothed': 2}
+
+
+def file_hash(full_filename: str, block_size: int = 2 ** 20):
+    sha1 = hashlib.sha1()
+    with open(full_filename, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _write_json(full_filename: str, content: dict):
+    tmp_filename = f'{full_filename}.{os.getpid()}.tmp'
+    with open(tmp_filename, 'w') as file:
+        json.dump(content, file, indent=1)
+    os.replace(tmp_filename, full_filename)
+
+
+def _source_record_filename(full_filename: str, cache_dir: str):
+    path_key = hashlib.sha1(os.path.abspath(full_filename).encode()).hexdigest()
+    return os.path.join(cache_dir, 'sources', f'{path_key}.json')
+
+
+def source_hash(full_filename: str, cache_dir: str):
+    """
+    Returns the content hash of full_filename, hashing it only if its size or modification time changed since the
+    last call.
+    """
+    stat = os.stat(full_filename)
+    record_filename = _source_record_filename(full_filename, cache_dir)
+    try:
+        with open(record_filename) as file:
+            record = json.load(file)
+        if record['size'] == stat.st_size and record['mtime_ns'] == stat.st_mtime_ns:
+            return record['hash']
+    except (OSError, ValueError, KeyError):
+        pass
+    record = {'source': os.path.abspath(full_filename), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+              'hash': file_hash(full_filename)}
+    os.makedirs(os.path.dirname(record_filename), exist_ok=True)
+    _write_json(record_filename, record)
+    return record['hash']
+
+
+def convert(full_filename: str, cache_dir: str):
+    """
+    Converts the pickled list of arrays in full_filename to the cache, if not already there.
+
+    :returns: the content hash that keys the converted arrays.
+    """
+    content_hash = source_hash(full_filename, cache_dir)
+    sidecar_filename = os.path.join(cache_dir, f'{content_hash}.json')
+    if os.path.exists(sidecar_filename):
+        return content_hash
+    with open(full_filename, 'rb') as file:
+        saving_list = pickle.load(file)
+    shapes = []
+    for i_array, array in enumerate(saving_list):
+        array = np.asarray(array)
+        npy_filename = os.path.join(cache_dir, f'{content_hash}_{i_array}.npy')
+        np.save(f'{npy_filename}.{os.getpid()}.tmp.npy', np.ascontiguousarray(array.T))
+        os.replace(f'{npy_filename}.{os.getpid()}.tmp.npy', npy_filename)
+        shapes.append(list(array.shape))
+    _write_json(sidecar_filename, {'source': os.path.basename(full_filename), 'shapes': shapes,
+                                   'dtypes': [str(np.asarray(array).dtype) for array in saving_list],
+                                   'variants': VARIANTS})
+    return content_hash
+
+
+def load_txy(full_filename: str, cache_dir: str, use_smoothed: bool = False):
+    """
+    Returns the t/x/y array (n_samples x 3) of full_filename, the smoothed or the raw one, memory-mapped from the
+    cache (converted first if needed). Only the slices actually used are read from disk.
+    """
+    content_hash = convert(full_filename, cache_dir)
+    i_array = VARIANTS['smoothed' if use_smoothed else 'raw']
+    return np.load(os.path.join(cache_dir, f'{content_hash}_{i_array}.npy'), mmap_mode='r').T
+
+
+if __name__ == '__main__':
+    assert len(sys.argv) > 2, 'usage: python response_cache.py cache_dir file [file ...]'
+    for source_filename in [filename for pattern in sys.argv[2:] for filename in sorted(glob.glob(pattern))]:
+        print(f'{source_filename}: {convert(source_filename, sys.argv[1])}')
@@ -0,0 +1,94 @@
+from collections.abc import Mapping
+import numpy as np
+
+KEYS = ('x', 'x_dot', 'x_ddot')
+
+
+class ResponseView(Mapping):
+    """
+    Dict-like, zero-copy view of the position, velocity and acceleration of one dof of a Responses, for the code
+    written for the former list of dicts: response['x'], response['x_dot'] and response['x_ddot'].
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data: np.ndarray):
+        self.data = data
+
+    def __getitem__(self, key):
+        try:
+            return self.data[KEYS.index(key)]
+        except ValueError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        self.data[KEYS.index(key)] = value
+
+    def __iter__(self):
+        return iter(KEYS)
+
+    def __len__(self):
+        return len(KEYS)
+
+
+class Responses:
+    """
+    Responses of all the dofs in a single contiguous array data of shape (n_dofs + 1, 3, n_samples): position,
+    velocity and acceleration (axis 1, in the order of KEYS) of each dof (axis 0), the reference frame first.
+    Indexing with an integer returns a ResponseView of one dof, so responses[i]['x'] works as with a list of dicts.
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data: np.ndarray):
+        assert isinstance(data, np.ndarray) and data.ndim == 3 and data.shape[1] == len(KEYS), \
+            'data must be a (n_dofs + 1, 3, n_samples) ndarray'
+        self.data = data
+
+    @classmethod
+    def from_list(cls, responses):
+        return cls(np.array([[response[key] for key in KEYS] for response in responses], dtype=float))
+
+    def to_list(self):
+        return [{key: response[key] for key in KEYS} for response in self]
+
+    @property
+    def n_samples(self):
+        return self.data.shape[2]
+
+    @property
+    def x(self):
+        return self.data[:, 0]
+
+    @property
+    def x_dot(self):
+        return self.data[:, 1]
+
+    @property
+    def x_ddot(self):
+        return self.data[:, 2]
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return Responses(self.data[index])
+        return ResponseView(self.data[index])
+
+    def __iter__(self):
+        return (ResponseView(data) for data in self.data)
+
+    def slice(self, i_ini: int = 0, i_fin: int = None):
+        """
+        Returns a zero-copy view of the samples i_ini:i_fin of all the dofs.
+        """
+        return Responses(self.data[:, :, i_ini:i_fin])
+
+    def states(self):
+        """
+        Returns a view of data as states of shape (n_samples, n_dofs + 1, 3), as used by rls.RegressorRows.
+        """
+        return self.data.transpose((2, 0, 1))
+
+
+def as_responses(responses):
+    return responses if isinstance(responses, Responses) else Responses.from_list(responses)
@@ -0,0 +1,237 @@
+"""
+Online identification by recursive least squares, for live feeds of tracked positions.
+
+Replay of the bundled records at real-time rate, with a latency report:
+
+    python rls.py
+"""
+import pickle
+import time
+from typing import List
+import numpy as np
+from lumped_mass_sysid import COLUMN_BUILDERS, get_elements_assembly, set_unknowns
+from solvers import column_scale
+from utils import ELEMENT_TYPES
+
+STATE_KEYS = ('x', 'x_dot', 'x_ddot')
+
+
+class RegressorRows:
+    """
+    Builds the rows of the system of get_ab_mats_assembly for a few samples at a time, from states of shape
+    (n_samples, n_dofs + 1, 3): position, velocity and acceleration of every dof, the reference frame first. The
+    element to column map is resolved once, on construction.
+
+    If offset_terms is True, a constant nuisance column per dof equation follows the n_unknowns element columns. It
+    absorbs the constant force of the position offsets of the tracker on the linear elements, so the positions need
+    no mean removal, as the boundary terms of frequency_domain.
+    """
+    def __init__(self, parameters: dict, dof_indexes: List[int], offset_terms: bool = True):
+        dofs, self.elements, dofs_columns = get_elements_assembly(None, parameters, dof_indexes)
+        self.n_unknowns = len(self.elements)
+        self.n_columns = self.n_unknowns + (len(dof_indexes) if offset_terms else 0)
+        self.offset_terms = offset_terms
+        self.dof_indexes = np.array(dof_indexes)
+        self.masses = np.array([dof.mass for dof in dofs])
+        self.equations = np.concatenate([np.full(len(columns), i_dof) for i_dof, columns in enumerate(dofs_columns)])
+        self.columns = np.concatenate([columns for columns in dofs_columns]).astype(np.intp)
+        self.i = np.concatenate([np.full(len(dof.element_js), dof.index) for dof in dofs])
+        self.j = np.concatenate([dof.element_js for dof in dofs])
+        element_types = [ELEMENT_TYPES[element_type] for dof in dofs for element_type in dof.element_types.tolist()]
+        self.keys = np.array([STATE_KEYS.index(COLUMN_BUILDERS[element_type][0]) for element_type in element_types],
+                             dtype=np.intp)
+        self.transforms = []
+        for element_type, (_, transform) in COLUMN_BUILDERS.items():
+            mask = np.array([_ == element_type for _ in element_types], dtype=bool)
+            if transform is not None and np.any(mask):
+                self.transforms.append((transform, mask))
+
+    def __call__(self, states: np.ndarray):
+        """
+        :returns: a_rows (n_samples x n_dofs x n_columns) and b_rows (n_samples x n_dofs), one equation per dof in
+        dof_indexes.
+        """
+        values = states[:, self.i, self.keys] - states[:, self.j, self.keys]
+        for transform, mask in self.transforms:
+            masked = values[:, mask]
+            transform(masked, out=masked)
+            values[:, mask] = masked
+        a_rows = np.zeros((states.shape[0], len(self.dof_indexes), self.n_columns))
+        a_rows[:, self.equations, self.columns] = values
+        if self.offset_terms:
+            equations = np.arange(len(self.dof_indexes))
+            a_rows[:, equations, self.n_unknowns + equations] = 1
+        b_rows = - self.masses * states[:, self.dof_indexes, 2]
+        return a_rows, b_rows
+
+
+class RunningDerivatives:
+    """
+    Estimates position, velocity and acceleration of every dof from a stream of positions, with the same finite
+    differences as get_responses. The state of sample k is available when sample k + 2 arrives. Positions are kept
+    as tracked: their offsets are left to the offset terms of RegressorRows.
+    """
+    def __init__(self, n_dofs: int, delta_t: float):
+        self.delta_t = delta_t
+        self.buffer = np.empty((0, n_dofs))
+
+    def push(self, positions: np.ndarray):
+        """
+        :param positions: n_samples x n_dofs positions (or n_dofs for a single sample).
+        :returns: states (n_new x (n_dofs + 1) x 3), with the reference frame (zeros) as dof 0. n_new is 0 until three
+        samples have been pushed.
+        """
+        positions = np.atleast_2d(positions)
+        self.buffer = np.vstack((self.buffer, positions))
+        x = self.buffer
+        n_new = max(x.shape[0] - 2, 0)
+        states = np.zeros((n_new, x.shape[1] + 1, 3))
+        states[:, 1:, 0] = x[:n_new]
+        states[:, 1:, 1] = (x[1:n_new + 1] - x[:n_new]) / self.delta_t
+        states[:, 1:, 2] = (x[2:n_new + 2] - 2 * x[1:n_new + 1] + x[:n_new]) / self.delta_t ** 2
+        self.buffer = x[n_new:]
+        return states
+
+
+class RecursiveLeastSquares:
+    """
+    Recursive least squares estimate of the unknowns of parameters, updated in O(p^2) per equation. Past samples are
+    weighted by forgetting_factor per sample (1 keeps them all, as the batch solution).
+
+    The first n_init samples are solved in batch to initialize the estimate and its covariance, since the columns of
+    different element types differ by orders of magnitude and no single initial covariance suits all of them.
+    p_init is the prior variance of the unknowns relative to unit norm columns; large values mean no prior knowledge.
+
+    gamma holds the unknowns in the order of the elements of the regressor followed, if offset_terms is True, by the
+    offset terms of each dof equation (see RegressorRows), which par_result leaves out.
+    """
+    def __init__(self, parameters: dict, dof_indexes: List[int], forgetting_factor: float = 1.0, n_init: int = 50,
+                 p_init: float = 1E10, offset_terms: bool = True):
+        assert 0 < forgetting_factor <= 1, 'forgetting_factor must be in (0, 1]'
+        self.parameters = parameters
+        self.regressor = RegressorRows(parameters, dof_indexes, offset_terms)
+        self.forgetting_factor = forgetting_factor
+        self.n_init = n_init
+        self.p_init = p_init
+        self.gamma = np.zeros(self.regressor.n_columns)
+        self.p_mat = None
+        self.n_samples = 0
+        self._init_rows = []
+
+    def _initialize(self, a_rows: np.ndarray, b_rows: np.ndarray):
+        weights = self.forgetting_factor ** np.arange(a_rows.shape[0] - 1, -1, -1).reshape((-1, 1, 1))
+        a_mat = (np.sqrt(weights) * a_rows).reshape((-1, self.regressor.n_columns))
+        b_mat = (np.sqrt(weights[:, :, 0]) * b_rows).reshape((-1, 1))
+        ata_mat = np.dot(a_mat.T, a_mat)
+        scale = column_scale(ata_mat=ata_mat)
+        ata_reg = scale * ata_mat * scale.T + np.eye(self.regressor.n_columns) / self.p_init
+        self.p_mat = scale * np.linalg.inv(ata_reg) * scale.T
+        self.gamma = np.dot(self.p_mat, np.dot(a_mat.T, b_mat))[:, 0]
+
+    def update(self, states: np.ndarray):
+        """
+        Updates the estimate with states (n_samples x (n_dofs + 1) x 3), e.g. from RunningDerivatives.push.
+        """
+        a_rows, b_rows = self.regressor(states)
+        self.n_samples += states.shape[0]
+        if self.p_mat is None:
+            self._init_rows.append((a_rows, b_rows))
+            if self.n_samples < self.n_init:
+                return self.gamma
+            a_rows, b_rows = [np.concatenate(rows) for rows in zip(*self._init_rows)]
+            self._init_rows = []
+            self._initialize(a_rows[:self.n_init], b_rows[:self.n_init])
+            a_rows, b_rows = a_rows[self.n_init:], b_rows[self.n_init:]
+        for a_sample, b_sample in zip(a_rows, b_rows):
+            self.p_mat /= self.forgetting_factor
+            for phi, target in zip(a_sample, b_sample):
+                p_phi = np.dot(self.p_mat, phi)
+                gain = p_phi / (1 + np.dot(phi, p_phi))
+                self.gamma += gain * (target - np.dot(phi, self.gamma))
+                self.p_mat -= np.outer(gain, p_phi)
+        return self.gamma
+
+    def par_result(self):
+        return set_unknowns(self.parameters, self.regressor.elements,
+                            self.gamma[:self.regressor.n_unknowns].reshape((-1, 1)))
+
+
+def replay_dat(responses_full_filenames: List[str], use_smoothed: bool = True, realtime: bool = True,
+               speed: float = 1.0, batch_size: int = 1):
+    """
+    Stand-in for a live tracking feed: yields (t, positions) with batches of batch_size samples of the position of
+    every dof read from the .dat files, paced at real-time rate (times speed) if realtime is True.
+    """
+    txys = []
+    for full_filename in responses_full_filenames:
+        with open(full_filename, 'rb') as file:
+            saving_list = pickle.load(file)
+        txys.append(saving_list[2] if use_smoothed else saving_list[1])
+    n_samples = min(txy.shape[0] for txy in txys)
+    t = txys[0][:n_samples, 0]
+    positions = np.column_stack([txy[:n_samples, 1] for txy in txys])
+    t_start = time.perf_counter()
+    for i_ini in range(0, n_samples, batch_size):
+        i_fin = min(i_ini + batch_size, n_samples)
+        if realtime:
+            wait = (t[i_fin - 1] - t[0]) / speed - (time.perf_counter() - t_start)
+            if wait > 0:
+                time.sleep(wait)
+        yield t[i_ini:i_fin], positions[i_ini:i_fin]
+
+
+def run_online(feed, derivatives: RunningDerivatives, estimator: RecursiveLeastSquares, callback=None):
+    """
+    Feeds every batch of feed through derivatives and estimator.
+
+    :param callback: Optional function called with (t, gamma) after each update.
+    :returns: update_times, the wall time of each update (derivatives plus estimator) per sample, in seconds.
+    """
+    update_times = []
+    for t, positions in feed:
+        t_ini = time.perf_counter()
+        states = derivatives.push(positions)
+        if states.shape[0]:
+            estimator.update(states)
+        update_times.append((time.perf_counter() - t_ini) / positions.shape[0])
+        if callback is not None:
+            callback(t, estimator.gamma)
+    return np.array(update_times)
+
+
+def latency_report(update_times: np.ndarray, frame_period: float):
+    """
+    :returns: dict with the mean, median, 99th percentile and maximum update time per sample, and the fraction of
+    the frame period they take.
+    """
+    report = {'frame_period': frame_period,
+              'mean': np.mean(update_times),
+              'median': np.median(update_times),
+              'p99': np.percentile(update_times, 99),
+              'max': np.max(update_times)}
+    for key in ['mean', 'median', 'p99', 'max']:
+        report[f'{key}_frame_fraction'] = report[key] / frame_period
+    return report
+
+
+if __name__ == '__main__':
+    import pprint as pp
+    from lumped_mass_sysid import get_ab_mats_assembly
+    from utils import get_responses, Parameters, t2delta_t
+
+    responses_full_filenames = ['txy_dof1_m.dat', 'txy_dof2_m.dat']
+    parameters = Parameters(dof_masses=[32.37, 26.007], fully_connected_c=True).parameters
+    with open(responses_full_filenames[0], 'rb') as file:
+        delta_t = t2delta_t(pickle.load(file)[2][:, 0])
+    # Without forgetting, the online estimate is the batch one, up to the offset terms replacing the mean removal.
+    estimator = RecursiveLeastSquares(parameters, dof_indexes=[1, 2], forgetting_factor=1.0)
+    update_times = run_online(replay_dat(responses_full_filenames, realtime=True),
+                              RunningDerivatives(n_dofs=2, delta_t=delta_t), estimator)
+    par_result = estimator.par_result()
+    _, responses = get_responses(responses_full_filenames, True, True, use_smoothed=True)
+    par_batch = get_ab_mats_assembly(responses, parameters, [1, 2], solve_and_ret=True)[4]
+    pp.pprint(par_result)
+    pp.pprint({name: {'online': value, 'batch': par_batch['unknown'][name],
+                      'relative_difference': abs(value - par_batch['unknown'][name]) / abs(par_batch['unknown'][name])}
+               for name, value in par_result['unknown'].items()})
+    pp.pprint(latency_report(update_times, frame_period=delta_t))
@@ -0,0 +1,117 @@
+"""
+Forward simulation of identified lumped-mass models, to validate them by simulation error rather than by the one
+step force residual only.
+
+The equation of each dof i is the one identified by get_ab_mats: m_i x_i'' = - sum_e gamma_e phi_e(x_i - x_j) over
+the elements e between i and j (j = 0 being the fixed reference frame), with phi = x (k), x' (c), x'' (b), x^2 (k2),
+x^3 (k3) or sign(x') (muN). Inerters b enter the mass matrix. Many parameter sets sharing the number of dofs are
+integrated at once with a fixed step Runge-Kutta 4 scheme, as one batch of arrays.
+"""
+from typing import List
+import numpy as np
+from utils import check_responses_integrity, ELEMENT_TYPES, stack_parameters
+
+# Relative response each element type acts on, and parity of phi (phi(-d) = parity * phi(d)).
+ELEMENT_FORCES = {'k': ('x', lambda d: d, -1),
+                  'c': ('x_dot', lambda d: d, -1),
+                  'k2': ('x', np.square, 1),
+                  'k3': ('x', lambda d: d ** 3, -1),
+                  'muN': ('x_dot', np.sign, -1)}
+
+
+class BatchedModel:
+    """
+    Models of par_results (parameters dicts as returned by set_unknowns, e.g. bootstrap draws or structure
+    candidates) stacked for batched simulation. The elements are the union of the unknowns of all the dicts, with 0
+    for the ones a dict lacks.
+    """
+    def __init__(self, par_results: List[dict]):
+        self.masses, table, values = stack_parameters(par_results)
+        self.n_sets, n_dofs = self.masses.shape
+        self.n_dofs = n_dofs
+        assert len(table) == 0 or max(table.i.max(), table.j.max()) <= n_dofs, 'Element connected to unknown dof'
+        # Inerters: mass matrices and their inverses, constant in time.
+        is_inerter = table.types == ELEMENT_TYPES.index('b')
+        self.m_mats = None
+        if np.any(is_inerter):
+            incidence = self._incidence(table.i[is_inerter], table.j[is_inerter], -1)
+            self.m_mats = np.einsum('ed,se,ef->sdf', incidence, values[:, is_inerter], incidence)
+            self.m_mats[:, np.arange(n_dofs), np.arange(n_dofs)] += self.masses
+            self.m_mats_inv = np.linalg.inv(self.m_mats)
+        # Other elements, grouped by type.
+        self.groups = []
+        for element_type, (key, phi, parity) in ELEMENT_FORCES.items():
+            mask = table.types == ELEMENT_TYPES.index(element_type)
+            if np.any(mask):
+                self.groups.append((key, phi, table.i[mask], table.j[mask], values[:, mask],
+                                    self._incidence(table.i[mask], table.j[mask], parity)))
+
+    def _incidence(self, i: np.ndarray, j: np.ndarray, parity: int):
+        """
+        Returns the n_elements x n_dofs matrix that maps phi(x_i - x_j) of each element to its generalized force on
+        its two dofs (phi(x_j - x_i) = parity * phi(x_i - x_j) on the j end). The reference frame is dropped.
+        """
+        incidence = np.zeros((i.shape[0], self.n_dofs + 1))
+        elements = np.arange(i.shape[0])
+        incidence[elements, i] += 1
+        incidence[elements, j] += parity
+        return incidence[:, 1:]
+
+    def accelerations(self, x: np.ndarray, x_dot: np.ndarray):
+        """
+        :param x: n_sets x n_dofs positions (or n_dofs, shared by all sets), and x_dot likewise.
+        :returns: n_sets x n_dofs accelerations.
+        """
+        responses = {'x': np.zeros((self.n_sets, self.n_dofs + 1)), 'x_dot': np.zeros((self.n_sets, self.n_dofs + 1))}
+        responses['x'][:, 1:], responses['x_dot'][:, 1:] = x, x_dot
+        forces = np.zeros((self.n_sets, self.n_dofs))
+        for key, phi, i, j, values, incidence in self.groups:
+            forces -= np.dot(values * phi(responses[key][:, i] - responses[key][:, j]), incidence)
+        if self.m_mats is None:
+            return forces / self.masses
+        return np.matmul(self.m_mats_inv, forces[:, :, np.newaxis])[:, :, 0]
+
+
+def simulate(model: BatchedModel, x_0: np.ndarray, x_dot_0: np.ndarray, delta_t: float, n_samples: int,
+             substeps: int = 1):
+    """
+    Integrates the free response of every model of the batch with Runge-Kutta 4 and a step of delta_t / substeps.
+
+    :param x_0: Initial positions, n_sets x n_dofs (or n_dofs, shared by all sets), and x_dot_0 likewise.
+    :returns: t (n_samples) and the positions and velocities, each n_sets x n_samples x n_dofs, every delta_t.
+    """
+    h = delta_t / substeps
+    x = np.broadcast_to(np.asarray(x_0, dtype=float), (model.n_sets, model.n_dofs)).copy()
+    x_dot = np.broadcast_to(np.asarray(x_dot_0, dtype=float), (model.n_sets, model.n_dofs)).copy()
+    positions = np.empty((model.n_sets, n_samples, model.n_dofs))
+    velocities = np.empty((model.n_sets, n_samples, model.n_dofs))
+    for i_sample in range(n_samples):
+        positions[:, i_sample], velocities[:, i_sample] = x, x_dot
+        for _ in range(substeps):
+            k1_x, k1_v = x_dot, model.accelerations(x, x_dot)
+            k2_x, k2_v = x_dot + h / 2 * k1_v, model.accelerations(x + h / 2 * k1_x, x_dot + h / 2 * k1_v)
+            k3_x, k3_v = x_dot + h / 2 * k2_v, model.accelerations(x + h / 2 * k2_x, x_dot + h / 2 * k2_v)
+            k4_x, k4_v = x_dot + h * k3_v, model.accelerations(x + h * k3_x, x_dot + h * k3_v)
+            x = x + h / 6 * (k1_x + 2 * k2_x + 2 * k3_x + k4_x)
+            x_dot = x_dot + h / 6 * (k1_v + 2 * k2_v + 2 * k3_v + k4_v)
+    return np.arange(n_samples) * delta_t, positions, velocities
+
+
+def simulation_error(par_results: List[dict], responses: List[dict], dof_indexes: List[int], delta_t: float,
+                     substeps: int = 1):
+    """
+    Simulates every model of par_results from the measured initial state of responses and compares the simulated
+    positions with the measured ones.
+
+    :returns: nrmse (n_sets x n_dofs, RMS of the position error over the RMS of the measured position, per dof in
+    dof_indexes) and the simulated positions (n_sets x n_samples x n_dofs).
+    """
+    n_samples = check_responses_integrity(responses)
+    model = BatchedModel(par_results)
+    x_measured = np.array([responses[i_dof]['x'] for i_dof in range(1, model.n_dofs + 1)]).T
+    x_dot_0 = np.array([responses[i_dof]['x_dot'][0] for i_dof in range(1, model.n_dofs + 1)])
+    _, positions, _ = simulate(model, x_measured[0], x_dot_0, delta_t, n_samples, substeps)
+    columns = np.array(dof_indexes) - 1
+    errors = positions[:, :, columns] - x_measured[:, columns]
+    nrmse = np.sqrt(np.mean(errors ** 2, axis=1)) / np.sqrt(np.mean(x_measured[:, columns] ** 2, axis=0))
+    return nrmse, positions
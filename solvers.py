@@ -0,0 +1,181 @@
+import time
+import numpy as np
+
+SOLVERS = ['lstsq', 'qr', 'cholesky', 'pinv', 'ridge']
+
+
+def check_solver(solver):
+    assert solver in SOLVERS, f'Unsupported solver: {solver}'
+
+
+def column_scale(a_mat: np.ndarray = None, ata_mat: np.ndarray = None):
+    """
+    Returns a column (p x 1) with the inverse of the norm of each column of A, computed from a_mat or from the
+    diagonal of ata_mat. Zero columns are left unscaled.
+    """
+    norms = np.linalg.norm(a_mat, axis=0) if ata_mat is None else np.sqrt(np.abs(np.diag(ata_mat)))
+    return np.where(norms > 0, 1 / np.where(norms > 0, norms, 1), 1).reshape((-1, 1))
+
+
+def ridge_path(a_mat: np.ndarray, b_mat: np.ndarray, lambdas=None, n_lambdas: int = 100):
+    """
+    Returns the Tikhonov (ridge) solutions of a_mat x gamma_mat = b_mat for every lambda in lambdas, all of them
+    computed from a single SVD of the column scaled a_mat. lambdas apply to the scaled problem, so they are relative
+    to unit norm columns. If lambdas is None, n_lambdas values log-spaced between 1E-12 and 1 times the largest
+    squared singular value are used.
+
+    :returns: lambdas, gamma_mats (n_lambdas x p x 1), the generalized cross validation score of each lambda and the
+    singular values of the scaled a_mat (descending), e.g. for its condition number.
+    """
+    scale = column_scale(a_mat)
+    u_mat, s_vals, vt_mat = np.linalg.svd(a_mat * scale.T, full_matrices=False)
+    utb = np.dot(u_mat.T, b_mat)
+    lambdas = np.logspace(-12, 0, n_lambdas) * s_vals[0] ** 2 if lambdas is None else np.asarray(lambdas, float)
+    filters = s_vals / (s_vals ** 2 + lambdas.reshape((-1, 1)))
+    gamma_mats = scale * np.einsum('pq,lq,qi->lpi', vt_mat.T, filters, utb)
+    hat_traces = np.sum(s_vals * filters, axis=1)
+    residual_ss = np.sum(b_mat ** 2) - np.sum(utb ** 2) + np.dot((1 - s_vals * filters) ** 2, utb[:, 0] ** 2)
+    n_rows = a_mat.shape[0]
+    gcv = n_rows * residual_ss / (n_rows - hat_traces) ** 2
+    return lambdas, gamma_mats, gcv, s_vals
+
+
+def ridge_path_gram(ata_mat: np.ndarray, atb_mat: np.ndarray, btb: float, n_rows: int, lambdas=None,
+                    n_lambdas: int = 100):
+    """
+    Same as ridge_path, from the normal equations A^T A, A^T b and b^T b of a system with n_rows rows. The single
+    factorization is the eigendecomposition of the column scaled A^T A, whose eigenvalues give the singular values
+    returned.
+    """
+    scale = column_scale(ata_mat=ata_mat)
+    ata_scaled = scale * ata_mat * scale.T
+    eig_vals, eig_vecs = np.linalg.eigh(ata_scaled)
+    eig_vals = np.maximum(eig_vals, 0)
+    vtb = np.dot(eig_vecs.T, scale * atb_mat)
+    lambdas = np.logspace(-12, 0, n_lambdas) * eig_vals[-1] if lambdas is None else np.asarray(lambdas, float)
+    filters = 1 / (eig_vals + lambdas.reshape((-1, 1)))
+    gammas_scaled = np.einsum('pq,lq,qi->lpi', eig_vecs, filters, vtb)
+    gamma_mats = scale * gammas_scaled
+    residual_ss = btb - 2 * np.einsum('lpi,pi->l', gammas_scaled, scale * atb_mat) + \
+        np.einsum('lpi,pq,lqi->l', gammas_scaled, ata_scaled, gammas_scaled)
+    hat_traces = np.sum(eig_vals * filters, axis=1)
+    gcv = n_rows * np.maximum(residual_ss, 0) / (n_rows - hat_traces) ** 2
+    return lambdas, gamma_mats, gcv, np.sqrt(eig_vals[::-1])
+
+
+def solve(a_mat: np.ndarray, b_mat: np.ndarray, solver: str = 'pinv', ridge_lambda: float = None):
+    """
+    Solves a_mat x gamma_mat = b_mat in the least squares sense with the chosen backend. Columns are scaled to unit
+    norm before the factorization.
+
+    :param solver: 'lstsq' (LAPACK gelsd), 'qr' (Householder QR), 'cholesky' (Cholesky on the normal equations),
+    'pinv' (SVD pseudo-inverse) or 'ridge' (Tikhonov regularization on the SVD).
+    :param ridge_lambda: Regularization of the scaled problem for solver 'ridge'. If None, it is chosen by
+    generalized cross validation along ridge_path.
+    :returns: gamma_mat (p x 1) and a report dict with the solver, the condition number of the scaled A and the
+    runtime in seconds (and the chosen lambda for 'ridge').
+    """
+    check_solver(solver)
+    t_ini = time.perf_counter()
+    report = {'solver': solver}
+    scale = column_scale(a_mat)
+    a_scaled = a_mat * scale.T
+    if solver == 'lstsq':
+        gamma_scaled, _, _, s_vals = np.linalg.lstsq(a_scaled, b_mat, rcond=None)
+        report['cond'] = s_vals[0] / s_vals[-1]
+    elif solver == 'qr':
+        q_mat, r_mat = np.linalg.qr(a_scaled)
+        gamma_scaled = np.linalg.solve(r_mat, np.dot(q_mat.T, b_mat))
+        report['cond'] = np.linalg.cond(r_mat)
+    elif solver == 'cholesky':
+        gamma_mat, report = solve_gram(np.dot(a_mat.T, a_mat), np.dot(a_mat.T, b_mat), solver='cholesky')
+        report['runtime'] = time.perf_counter() - t_ini
+        return gamma_mat, report
+    elif solver == 'pinv':
+        u_mat, s_vals, vt_mat = np.linalg.svd(a_scaled, full_matrices=False)
+        s_inv = np.where(s_vals > 1E-15 * s_vals[0], 1 / np.where(s_vals > 0, s_vals, 1), 0)
+        gamma_scaled = np.dot(vt_mat.T, s_inv.reshape((-1, 1)) * np.dot(u_mat.T, b_mat))
+        report['cond'] = s_vals[0] / s_vals[-1]
+    else:
+        lambdas, gamma_mats, gcv, s_vals = ridge_path(a_mat, b_mat,
+                                                      lambdas=None if ridge_lambda is None else [ridge_lambda])
+        report['cond'] = s_vals[0] / s_vals[-1]
+        report['ridge_lambda'] = lambdas[np.argmin(gcv)]
+        report['runtime'] = time.perf_counter() - t_ini
+        return gamma_mats[np.argmin(gcv)], report
+    report['runtime'] = time.perf_counter() - t_ini
+    return scale * gamma_scaled, report
+
+
+def solve_gram(ata_mat: np.ndarray, atb_mat: np.ndarray, solver: str = 'pinv', ridge_lambda: float = None,
+               btb: float = None, n_rows: int = None):
+    """
+    Solves the normal equations A^T A gamma_mat = A^T b. Only the backends that need A^T A alone are available:
+    'cholesky', 'pinv' and 'ridge'. Automatic choice of the ridge lambda needs btb and n_rows.
+
+    :returns: gamma_mat (p x 1) and a report dict as in solve. The reported condition number is the one of the scaled
+    A, i.e. the square root of the one of the scaled A^T A.
+    """
+    check_solver(solver)
+    assert solver in ['cholesky', 'pinv', 'ridge'], f'Solver {solver} needs A, not only A^T A'
+    t_ini = time.perf_counter()
+    report = {'solver': solver}
+    scale = column_scale(ata_mat=ata_mat)
+    ata_scaled = scale * ata_mat * scale.T
+    atb_scaled = scale * atb_mat
+    if solver == 'cholesky':
+        l_mat = np.linalg.cholesky(ata_scaled)
+        gamma_scaled = np.linalg.solve(l_mat.T, np.linalg.solve(l_mat, atb_scaled))
+        s_vals = np.linalg.svd(l_mat, compute_uv=False)
+        report['cond'] = s_vals[0] / s_vals[-1]
+    elif solver == 'pinv':
+        gamma_scaled = np.dot(np.linalg.pinv(ata_scaled, hermitian=True), atb_scaled)
+        eig_vals = np.linalg.eigvalsh(ata_scaled)
+        report['cond'] = np.sqrt(eig_vals[-1] / eig_vals[0]) if eig_vals[0] > 0 else np.inf
+    else:
+        assert ridge_lambda is not None or (btb is not None and n_rows is not None), \
+            'ridge_lambda, or btb and n_rows for its automatic choice, must be given'
+        lambdas, gamma_mats, gcv, s_vals = ridge_path_gram(ata_mat, atb_mat, 0 if btb is None else btb,
+                                                           1 if n_rows is None else n_rows,
+                                                           lambdas=None if ridge_lambda is None else [ridge_lambda])
+        report['cond'] = s_vals[0] / s_vals[-1] if s_vals[-1] > 0 else np.inf
+        report['ridge_lambda'] = lambdas[np.argmin(gcv)]
+        report['runtime'] = time.perf_counter() - t_ini
+        return gamma_mats[np.argmin(gcv)], report
+    report['runtime'] = time.perf_counter() - t_ini
+    return scale * gamma_scaled, report
+
+
+def solve_gram_batch(ata_mats: np.ndarray, atb_mats: np.ndarray):
+    """
+    Solves a stack of normal equations at once, e.g. one per time window or per bootstrap replicate, with the
+    column scaled pseudo-inverse (O(p^3) per system, no loop in Python).
+
+    :param ata_mats: n_systems x p x p.
+    :param atb_mats: n_systems x p x 1.
+    :returns: gamma_mats (n_systems x p x 1). Systems whose A^T A is all zeros get zeros.
+    """
+    diags = np.abs(np.diagonal(ata_mats, axis1=1, axis2=2))
+    scales = np.where(diags > 0, 1 / np.sqrt(np.where(diags > 0, diags, 1)), 1)[:, :, np.newaxis]
+    ata_scaled = scales * ata_mats * np.swapaxes(scales, 1, 2)
+    return scales * np.matmul(np.linalg.pinv(ata_scaled, hermitian=True), scales * atb_mats)
+
+
+def compare_solvers(a_mat: np.ndarray, b_mat: np.ndarray, solvers=None, ridge_lambda: float = None):
+    """
+    Runs every backend in solvers (all of them by default) on the same system.
+
+    :returns: list of report dicts as in solve, with the RMS of the residual and gamma_mat added. Backends that fail
+    (e.g. Cholesky on a rank deficient A) report the error instead.
+    """
+    reports = []
+    for solver in SOLVERS if solvers is None else solvers:
+        try:
+            gamma_mat, report = solve(a_mat, b_mat, solver=solver, ridge_lambda=ridge_lambda)
+        except np.linalg.LinAlgError as error:
+            reports.append({'solver': solver, 'error': str(error)})
+            continue
+        report['residual_rms'] = np.sqrt(np.mean((np.dot(a_mat, gamma_mat) - b_mat) ** 2))
+        report['gamma_mat'] = gamma_mat
+        reports.append(report)
+    return reports
@@ -0,0 +1,105 @@
+"""
+On-disk memoization of the stages of pipeline.py.
+
+The output of each stage is pickled under a key hashed from the key of the stage upstream and the settings the stage
+depends on; the first stage hashes the content of the source files (see response_cache.source_hash). Changing a
+setting thus recomputes only the stage that reads it and the ones downstream. Entries are evicted least recently used
+first when the cache grows over max_bytes.
+"""
+import hashlib
+import json
+import os
+import pickle
+from response_cache import source_hash
+
+ENTRY_EXTENSION = '.pkl'
+
+
+def settings_hash(*items):
+    """
+    Returns the hash of items (JSON serializable: settings dicts, upstream keys, file hashes).
+    """
+    return hashlib.sha1(json.dumps(items, sort_keys=True, default=repr).encode()).hexdigest()
+
+
+class StageCache:
+    def __init__(self, cache_dir: str, max_bytes: int = 2 ** 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits, self.misses = 0, 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def files_key(self, full_filenames):
+        return settings_hash([source_hash(full_filename, self.cache_dir) for full_filename in full_filenames])
+
+    def _entry_filename(self, stage: str, key: str):
+        return os.path.join(self.cache_dir, f'{stage}_{key}{ENTRY_EXTENSION}')
+
+    def get(self, stage: str, key: str):
+        """
+        :returns: (True, output) if the output of stage for key is cached, else (False, None).
+        """
+        entry_filename = self._entry_filename(stage, key)
+        try:
+            with open(entry_filename, 'rb') as file:
+                output = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return False, None
+        try:
+            os.utime(entry_filename)
+        except OSError:
+            pass
+        self.hits += 1
+        return True, output
+
+    def put(self, stage: str, key: str, output):
+        entry_filename = self._entry_filename(stage, key)
+        tmp_filename = f'{entry_filename}.{os.getpid()}.tmp'
+        with open(tmp_filename, 'wb') as file:
+            pickle.dump(output, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, entry_filename)
+        self.evict()
+
+    def memoize(self, stage: str, key: str, func, *args, **kwargs):
+        """
+        Returns the cached output of stage for key, or computes it as func(*args, **kwargs) and caches it.
+        """
+        is_cached, output = self.get(stage, key)
+        if not is_cached:
+            output = func(*args, **kwargs)
+            self.put(stage, key, output)
+        return output
+
+    def entries(self):
+        """
+        :returns: list of (last access time, size in bytes, full filename) of the cached entries.
+        """
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(ENTRY_EXTENSION):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache holds at most max_bytes.
+        """
+        entries = sorted(self.entries())
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, full_filename in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(full_filename)
+            except OSError:
+                pass
+            total_bytes -= size
+
+    def clear(self):
+        for _, _, full_filename in self.entries():
+            os.remove(full_filename)
@@ -0,0 +1,159 @@
+import os
+from itertools import product
+from typing import List
+import numpy as np
+from lumped_mass_sysid import get_block_normal_eqs
+from parallel import shared_pool, worker_shared
+from solvers import solve_gram
+from utils import ELEMENT_TYPES, Parameters, check_element_type
+
+TOPOLOGIES = [None, 'chain_like', 'fully_connected']
+CRITERIA = ['aic', 'bic', 'holdout_rms']
+
+
+def candidate_structures(element_types=('k', 'c'), topologies=TOPOLOGIES):
+    """
+    Returns every combination of a topology (None, 'chain_like' or 'fully_connected') per element type, as dicts
+    {element_type: topology}. The structure without any element is left out.
+    """
+    [check_element_type(element_type) for element_type in element_types]
+    structures = [dict(zip(element_types, combination))
+                  for combination in product(topologies, repeat=len(element_types))]
+    return [structure for structure in structures if any(structure.values())]
+
+
+def structure2flags(structure: dict):
+    """
+    Returns the fully_connected_*/chain_like_* keyword arguments of Parameters for structure.
+    """
+    flags = {}
+    for element_type in ELEMENT_TYPES:
+        flags[f'fully_connected_{element_type}'] = structure.get(element_type) == 'fully_connected'
+        flags[f'chain_like_{element_type}'] = structure.get(element_type) == 'chain_like'
+    return flags
+
+
+def structure_names(structure: dict, n_dofs: int):
+    """
+    Returns the names of the unknowns of structure in a system with n_dofs masses.
+    """
+    return list(Parameters(dof_masses=[1.0] * n_dofs, **structure2flags(structure)).parameters['unknown'].keys())
+
+
+def get_block_grams(responses: List[dict], parameters: dict, dof_indexes: List[int], n_blocks: int = 10,
+                    holdout_every: int = 5, chunk_size: int = 2 ** 14):
+    """
+    Splits the responses in n_blocks contiguous blocks of samples (see get_block_normal_eqs) and sums the normal
+    equations of the system of parameters over the blocks used for fitting and over the blocks held out (one in every
+    holdout_every).
+
+    :returns: grams, a dict with 'ata', 'atb', 'btb' and 'n_rows' for 'fit', 'holdout' (if any block is held out)
+    and 'all' blocks, and elements_assembly.
+    """
+    ata_blocks, atb_blocks, btb_blocks, n_rows_blocks, elements_assembly = \
+        get_block_normal_eqs(responses, parameters, dof_indexes, n_blocks, chunk_size)
+    held_out = np.array([bool(holdout_every) and (i_block + 1) % holdout_every == 0 for i_block in range(n_blocks)])
+    grams = {}
+    for subset, blocks in (('fit', ~held_out), ('holdout', held_out), ('all', np.ones(n_blocks, dtype=bool))):
+        if np.any(blocks):
+            grams[subset] = {'ata': ata_blocks[blocks].sum(axis=0), 'atb': atb_blocks[blocks].sum(axis=0),
+                             'btb': btb_blocks[blocks].sum(), 'n_rows': int(n_rows_blocks[blocks].sum())}
+    return grams, elements_assembly
+
+
+def residual_ss(gram: dict, columns: np.ndarray, gamma_mat: np.ndarray):
+    gamma = gamma_mat[:, 0]
+    return gram['btb'] - 2 * np.dot(gamma, gram['atb'][columns, 0]) + \
+        np.dot(gamma, np.dot(gram['ata'][np.ix_(columns, columns)], gamma))
+
+
+def information_criteria(rss: float, n_rows: int, n_params: int):
+    log_likelihood_term = n_rows * np.log(max(rss, np.finfo(float).tiny) / n_rows)
+    return log_likelihood_term + 2 * n_params, log_likelihood_term + n_params * np.log(n_rows)
+
+
+def solve_candidate(grams: dict, columns: np.ndarray, solver: str = 'pinv'):
+    """
+    Solves the candidate made of the superset columns from the sub-blocks of the Gram matrices in grams.
+
+    :returns: dict with gamma_mat (fitted on all the blocks), rss, aic, bic and holdout_rms (fitted on the 'fit'
+    blocks and evaluated on the 'holdout' ones, nan without held out blocks).
+    """
+    gamma_mat, _ = solve_gram(grams['all']['ata'][np.ix_(columns, columns)], grams['all']['atb'][columns],
+                              solver=solver)
+    rss = residual_ss(grams['all'], columns, gamma_mat)
+    aic, bic = information_criteria(rss, grams['all']['n_rows'], len(columns))
+    holdout_rms = np.nan
+    if 'holdout' in grams:
+        gamma_fit, _ = solve_gram(grams['fit']['ata'][np.ix_(columns, columns)], grams['fit']['atb'][columns],
+                                  solver=solver)
+        holdout_rms = np.sqrt(max(residual_ss(grams['holdout'], columns, gamma_fit), 0) / grams['holdout']['n_rows'])
+    return {'gamma_mat': gamma_mat, 'rss': rss, 'aic': aic, 'bic': bic, 'holdout_rms': holdout_rms}
+
+
+def _solve_candidates(columns_list: list):
+    shared = worker_shared()
+    return [solve_candidate(shared['grams'], columns, shared['solver']) for columns in columns_list]
+
+
+def search_structures(responses: List[dict], dof_masses: List[float], dof_indexes: List[int],
+                      element_types=('k', 'c'), structures: List[dict] = None, criterion: str = 'bic',
+                      prune: bool = True, processes: int = None, batch_size: int = 64, n_blocks: int = 10,
+                      holdout_every: int = 5, solver: str = 'pinv'):
+    """
+    Identifies every candidate structure from a single assembly: the superset system (all element types fully
+    connected) is assembled once and reduced to Gram matrices, and each candidate is solved from the sub-blocks of
+    those matrices.
+
+    :param structures: Candidate structures as returned by candidate_structures. By default, all the combinations
+    for element_types.
+    :param criterion: 'aic', 'bic' or 'holdout_rms'. Candidates are ranked by it.
+    :param prune: Branch and bound for 'aic' and 'bic': a candidate can not have less residual than the superset,
+    so candidates whose bound with the superset residual is worse than the best criterion found are not solved.
+    :param processes: Number of worker processes. 1 solves in this process; None uses all the cores.
+    :param batch_size: Number of candidates per task. Bounds are updated after each round of tasks.
+    :returns: list of dicts with 'structure', 'n_params', 'unknown' (name -> value), 'rss', 'aic', 'bic' and
+    'holdout_rms', sorted by criterion, and the number of pruned candidates.
+    """
+    assert criterion in CRITERIA, f'Unsupported criterion: {criterion}'
+    structures = candidate_structures(element_types) if structures is None else structures
+    superset_structure = {element_type: 'fully_connected' for structure in structures
+                          for element_type, topology in structure.items() if topology}
+    superset = Parameters(dof_masses=dof_masses, **structure2flags(superset_structure)).parameters
+    grams, elements_assembly = get_block_grams(responses, superset, dof_indexes, n_blocks=n_blocks,
+                                               holdout_every=holdout_every)
+    columns = {}
+    for column, element in enumerate(elements_assembly):
+        columns[element.__str__()] = columns[element.__str__(ji=True)] = column
+    candidates = []
+    for structure in structures:
+        names = [name for name in structure_names(structure, len(dof_masses)) if name in columns]
+        if names:
+            candidates.append((structure, names, np.array([columns[name] for name in names])))
+    candidates.sort(key=lambda candidate: len(candidate[1]))
+
+    prune = prune and criterion != 'holdout_rms'
+    bound_rss = solve_candidate(grams, np.arange(len(elements_assembly)), solver)['rss'] if prune else None
+    results, n_pruned, best = [], 0, np.inf
+    processes = os.cpu_count() if processes is None else processes
+    with shared_pool({'grams': grams, 'solver': solver}, processes) as pool_map:
+        n_round = batch_size * processes
+        for i_round in range(0, len(candidates), n_round):
+            round_candidates = []
+            for candidate in candidates[i_round:i_round + n_round]:
+                if prune:
+                    aic, bic = information_criteria(bound_rss, grams['all']['n_rows'], len(candidate[1]))
+                    bound = bic if criterion == 'bic' else aic
+                if prune and bound >= best:
+                    n_pruned += 1
+                else:
+                    round_candidates.append(candidate)
+            batches = [[candidate[2] for candidate in round_candidates[i:i + batch_size]]
+                       for i in range(0, len(round_candidates), batch_size)]
+            solutions = pool_map(_solve_candidates, batches)
+            for (structure, names, _), solution in zip(round_candidates, [s for batch in solutions for s in batch]):
+                solution['unknown'] = dict(zip(names, solution.pop('gamma_mat')[:, 0]))
+                results.append({'structure': structure, 'n_params': len(names), **solution})
+                best = min(best, results[-1][criterion])
+    results.sort(key=lambda result: result[criterion])
+    return results, n_pruned
@@ -1,12 +1,86 @@
 import pickle
 from typing import List
-from itertools import combinations
 import numpy as np
+from derivatives import differentiate, differentiated_range
+from response_cache import load_txy
+from responses import Responses
+
+
+ELEMENT_TYPES = ['b', 'c', 'k', 'k2', 'k3', 'muN']
 
 
 def check_element_type(element_type):
-    supported_element_types = ['b', 'c', 'k', 'k2', 'k3', 'muN']
-    assert element_type in supported_element_types, f'Unsupported element type: {element_type}'
+    assert element_type in ELEMENT_TYPES, f'Unsupported element type: {element_type}'
+
+
+class ElementTable:
+    """
+    Array-backed table of the unknown elements of a model, one row per element with integer columns types (index in
+    ELEMENT_TYPES), i and j. The 'type_i_j' keys of parameters['unknown'] are a view of it (see names).
+    """
+    __slots__ = ('types', 'i', 'j', '_incidence')
+
+    def __init__(self, types, i, j):
+        self.types = np.asarray(types, dtype=np.intp).reshape(-1)
+        self.i = np.asarray(i, dtype=np.intp).reshape(-1)
+        self.j = np.asarray(j, dtype=np.intp).reshape(-1)
+        assert self.types.shape == self.i.shape == self.j.shape, 'types, i and j must have the same length'
+        self._incidence = None
+
+    def __len__(self):
+        return self.types.shape[0]
+
+    @classmethod
+    def from_names(cls, names):
+        codes = {element_type: code for code, element_type in enumerate(ELEMENT_TYPES)}
+        fields = [name.split('_') for name in names]
+        try:
+            types = [codes[element_type] for element_type, _, _ in fields]
+        except KeyError as error:
+            raise AssertionError(f'Unsupported element type: {error.args[0]}')
+        return cls(types, [int(i) for _, i, _ in fields], [int(j) for _, _, j in fields])
+
+    @classmethod
+    def concatenate(cls, tables):
+        tables = list(tables)
+        return cls(*[np.concatenate([getattr(table, column) for table in tables] + [np.zeros(0, dtype=np.intp)])
+                     for column in ('types', 'i', 'j')])
+
+    def names(self):
+        return [f'{ELEMENT_TYPES[t]}_{i}_{j}' for t, i, j in zip(self.types.tolist(), self.i.tolist(), self.j.tolist())]
+
+    def incidence(self, dof_index: int):
+        """
+        Returns the rows of the elements connected to dof_index, in table order. The index of all dofs is computed
+        once, on first call.
+        """
+        if self._incidence is None:
+            rows = np.tile(np.arange(len(self)), 2)
+            ends = np.concatenate((self.i, self.j))
+            order = np.lexsort((rows, ends))
+            self._incidence = ends[order], rows[order]
+        ends, rows = self._incidence
+        return rows[np.searchsorted(ends, dof_index, side='left'):np.searchsorted(ends, dof_index, side='right')]
+
+
+def stack_parameters(par_results: List[dict]):
+    """
+    Stacks the parameters dicts of par_results (e.g. bootstrap draws or structure candidates) sharing the number of
+    dofs, for batched computations.
+
+    :returns: masses (n_sets x n_dofs), the ElementTable of the union of the unknowns of par_results and their values
+    (n_sets x n_elements, 0 where a dict lacks the element).
+    """
+    par_results = [par_results] if isinstance(par_results, dict) else list(par_results)
+    n_dofs = len(par_results[0]['known'])
+    assert all(len(par_result['known']) == n_dofs for par_result in par_results), \
+        'All the models must have the same number of dofs'
+    names = list(dict.fromkeys(name for par_result in par_results for name in par_result['unknown']))
+    masses = np.array([[par_result['known'][f'm_{i + 1}'] for i in range(n_dofs)] for par_result in par_results],
+                      dtype=float)
+    values = np.array([[par_result['unknown'].get(name, 0.0) for name in names] for par_result in par_results],
+                      dtype=float).reshape((len(par_results), len(names)))
+    return masses, ElementTable.from_names(names), values
 
 
 class Parameters:
@@ -45,15 +119,18 @@ class Parameters:
         elif chain_like_b:
             self.chain_like('b')
 
-    def fully_connected(self, element_type):
+    def add_elements(self, element_type, i, j):
         check_element_type(element_type)
-        for comb in combinations(range(1 + len(self.parameters['known'])), 2):
-            self.parameters['unknown'][f'{element_type}_{comb[0]}_{comb[1]}'] = 0.0
+        table = ElementTable(np.full(len(i), ELEMENT_TYPES.index(element_type)), i, j)
+        self.parameters['unknown'].update(dict.fromkeys(table.names(), 0.0))
+
+    def fully_connected(self, element_type):
+        i, j = np.triu_indices(1 + len(self.parameters['known']), k=1)
+        self.add_elements(element_type, i, j)
 
     def chain_like(self, element_type):
-        check_element_type(element_type)
-        for i in range(len(self.parameters['known'])):
-            self.parameters['unknown'][f'{element_type}_{i}_{i + 1}'] = 0.0
+        i = np.arange(len(self.parameters['known']))
+        self.add_elements(element_type, i, i + 1)
 
 
 def t2delta_t(t):
@@ -66,47 +143,76 @@ def t2delta_t(t):
     return delta_t
 
 
-def get_responses(responses_full_filenames, generate_referenceframe, remove_mean, i_ini=0, i_fin=None,
-                  use_smoothed=False, max_disp=np.inf):
-    responses = []
-    t, delta_t = None, None
-    i_last_max_list = []
+def load_positions(responses_full_filenames, remove_mean, i_ini=0, i_fin=None, use_smoothed=False, max_disp=np.inf,
+                   cache_dir=None):
+    """
+    Reads the positions in responses_full_filenames (pickled lists of t/x/y arrays), removes their mean if remove_mean
+    is True and drops the samples up to the last one over max_disp, for all dofs at once. If cache_dir is given, the
+    arrays are memory-mapped from the cache of response_cache instead of unpickled, so only the samples i_ini:i_fin of
+    the chosen variant are read.
+
+    :returns: t and x (n_dofs x n_samples positions).
+    """
+    t, positions = None, []
     for full_filename in responses_full_filenames:
-        with open(full_filename, 'rb') as file:
-            saving_list = pickle.load(file)
-            if use_smoothed:
-                txy = saving_list[2]
-            else:
-                txy = saving_list[1]
-        t = txy[i_ini:i_fin, 0] if t is None else t
-        delta_t = t2delta_t(t) if delta_t is None else delta_t
-        x = txy[i_ini:i_fin, 1] - txy[i_ini:i_fin, 1].mean() if remove_mean else txy[i_ini:i_fin, 1]
-        x = x.copy()
-        try:
-            i_last_max_list.append((np.where(np.abs(x) > max_disp))[0][-1])
-        except IndexError:
-            i_last_max_list.append(0)
-        if generate_referenceframe:
-            zeros = np.zeros(x[0:-2].size)
-            responses.append({'x': zeros,
-                              'x_dot': zeros,
-                              'x_ddot': zeros})
-            generate_referenceframe = False
-        responses.append({'x': x[0:-2],
-                          'x_dot': np.diff(x[0:-1]) / delta_t,
-                          'x_ddot': np.diff(x, 2) / (delta_t ** 2)})
-    i_last_max = max(i_last_max_list)
-    for response in responses:
-        response['x'] = response['x'][i_last_max:]
-        response['x_dot'] = response['x_dot'][i_last_max:]
-        response['x_ddot'] = response['x_ddot'][i_last_max:]
-    return t[i_last_max:-2], responses
+        if cache_dir is not None:
+            txy = load_txy(full_filename, cache_dir, use_smoothed=use_smoothed)
+        else:
+            with open(full_filename, 'rb') as file:
+                saving_list = pickle.load(file)
+                if use_smoothed:
+                    txy = saving_list[2]
+                else:
+                    txy = saving_list[1]
+        t = np.array(txy[i_ini:i_fin, 0]) if t is None else t
+        positions.append(txy[i_ini:i_fin, 1])
+    assert all(x.shape == t.shape for x in positions), 'All the responses must have the same number of samples'
+    x = np.array(positions, dtype=float)
+    if remove_mean:
+        x -= x.mean(axis=1, keepdims=True)
+    i_over_max = np.flatnonzero(np.any(np.abs(x) > max_disp, axis=0))
+    i_last_max = i_over_max[-1] if i_over_max.size else 0
+    return t[i_last_max:], x[:, i_last_max:]
+
+
+def positions2responses(t, x, generate_referenceframe, differentiator='diff', differentiator_settings=None):
+    """
+    Differentiates the positions x (n_dofs x n_samples) sampled at t and returns the time of the samples kept and
+    their Responses, with the reference frame first if generate_referenceframe is True.
+
+    :param differentiator: Velocity and acceleration estimator, one of derivatives.DIFFERENTIATORS ('diff', the
+    forward differences used so far, by default). differentiator_settings are passed to derivatives.differentiate
+    (e.g. {'window': 21, 'polyorder': 3} for 'savgol').
+    """
+    settings = {} if differentiator_settings is None else differentiator_settings
+    i_ref = 1 if generate_referenceframe else 0
+    i_start, n_out = differentiated_range(x.shape[1], differentiator, **settings)
+    data = np.zeros((i_ref + x.shape[0], 3, n_out))
+    differentiate(x, t2delta_t(t), differentiator, out=data[i_ref:], **settings)
+    return t[i_start:i_start + n_out], Responses(data)
+
+
+def get_responses(responses_full_filenames, generate_referenceframe, remove_mean, i_ini=0, i_fin=None,
+                  use_smoothed=False, max_disp=np.inf, cache_dir=None, differentiator='diff',
+                  differentiator_settings=None):
+    """
+    Returns the time and the Responses of the positions in responses_full_filenames (see load_positions and
+    positions2responses), with the reference frame first if generate_referenceframe is True. The returned time is
+    aligned with the samples kept by the differentiator.
+    """
+    t, x = load_positions(responses_full_filenames, remove_mean, i_ini, i_fin, use_smoothed, max_disp, cache_dir)
+    return positions2responses(t, x, generate_referenceframe, differentiator, differentiator_settings)
 
 
 def check_responses_integrity(responses, t=None):
     def is_1d_ndarray(arr):
         return True if (isinstance(arr, np.ndarray) and len(arr.shape) == 1) else False
 
+    if isinstance(responses, Responses):
+        assert t is None or (is_1d_ndarray(t) and t.shape[0] == responses.n_samples), \
+            'Each element of response must have the n_samples as t'
+        return responses.n_samples
+
     if t is None:
         n_samples = responses[0]['x'].shape[0]
     else:
@@ -131,19 +237,32 @@ def check_responses_integrity(responses, t=None):
     return n_samples
 
 
-def get_mck_mats(parameters):
-    m_1 = parameters['known']['m_1']
-    m_2 = parameters['known']['m_2']
-    m_mat = np.array([[m_1, 0],
-                      [0, m_2]])
-    c_0_1 = parameters['unknown']['c_0_1'] if 'c_0_1' in parameters['unknown'].keys() else 0
-    c_0_2 = parameters['unknown']['c_0_2'] if 'c_0_2' in parameters['unknown'].keys() else 0
-    c_1_2 = parameters['unknown']['c_1_2'] if 'c_1_2' in parameters['unknown'].keys() else 0
-    c_mat = np.array([[c_0_1 + c_1_2, -c_1_2],
-                      [-c_1_2, c_1_2 + c_0_2]])
-    k_0_1 = parameters['unknown']['k_0_1'] if 'k_0_1' in parameters['unknown'].keys() else 0
-    k_0_2 = parameters['unknown']['k_0_2'] if 'k_0_2' in parameters['unknown'].keys() else 0
-    k_1_2 = parameters['unknown']['k_1_2'] if 'k_1_2' in parameters['unknown'].keys() else 0
-    k_mat = np.array([[k_0_1 + k_1_2, -k_1_2],
-                      [-k_1_2, k_1_2 + k_0_2]])
-    return m_mat, c_mat, k_mat
+def element_matrix(n_dofs: int, i: np.ndarray, j: np.ndarray, values: np.ndarray):
+    """
+    Returns the n_dofs x n_dofs matrix of linear elements of values between dofs i and j (0 being the reference
+    frame): each adds its value to the diagonal terms of its dofs and subtracts it from their coupling terms.
+    """
+    matrix = np.zeros((n_dofs + 1, n_dofs + 1))
+    np.add.at(matrix, (i, i), values)
+    np.add.at(matrix, (j, j), values)
+    np.add.at(matrix, (i, j), -values)
+    np.add.at(matrix, (j, i), -values)
+    return matrix[1:, 1:]
+
+
+def get_mck_mats(parameters, ret_b_mat=False):
+    """
+    Returns the mass, damping and stiffness matrices of the linear elements of parameters, for any number of dofs and
+    any topology. Unknowns not identified (e.g. nonlinear elements) are left out.
+
+    :param ret_b_mat: Flag to also return the matrix of the inerters, as a fourth output.
+    """
+    n_dofs = len(parameters['known'])
+    m_mat = np.diag([parameters['known'][f'm_{i_dof + 1}'] for i_dof in range(n_dofs)])
+    table = ElementTable.from_names(parameters['unknown'].keys())
+    values = np.array(list(parameters['unknown'].values()), dtype=float)
+    mats = []
+    for element_type in ['c', 'k', 'b'] if ret_b_mat else ['c', 'k']:
+        rows = table.types == ELEMENT_TYPES.index(element_type)
+        mats.append(element_matrix(n_dofs, table.i[rows], table.j[rows], values[rows]))
+    return (m_mat, *mats)
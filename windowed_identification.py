@@ -0,0 +1,145 @@
+from typing import List
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from lumped_mass_sysid import get_ab_mats_assembly, get_elements_assembly, slice_responses, unknown_names
+from solvers import solve_gram_batch
+from utils import check_responses_integrity
+
+
+def get_sample_grams(responses: List[dict], parameters: dict, dof_indexes: List[int], chunk_size: int = 2 ** 14,
+                     block_size: int = None):
+    """
+    Returns the contribution of each sample (the rows of all the dofs at that time) to the normal equations of the
+    system assembled by get_ab_mats_assembly. Responses are assembled in chunks of chunk_size samples.
+
+    :param block_size: If given, the arrays hold instead block prefix sums, with a leading zero: row k is the sum of
+    the samples from the start of the block of sample k - 1 (blocks of block_size samples) to sample k - 1. They are
+    summed in place, without a second copy, and restarting every block keeps the sums of late samples from being
+    differences of the large sums of early ones (see window_sums).
+    :returns: ata_samples (n_samples x p x p), atb_samples (n_samples x p x 1), btb_samples (n_samples) and
+    elements_assembly. With block_size, the arrays have n_samples + 1 rows.
+    """
+    n_samples = check_responses_integrity(responses)
+    assembly = get_elements_assembly(responses, parameters, dof_indexes)
+    elements_assembly = assembly[1]
+    n_unknowns = len(elements_assembly)
+    offset = 0 if block_size is None else 1
+    ata_samples = np.empty((n_samples + offset, n_unknowns, n_unknowns))
+    atb_samples = np.empty((n_samples + offset, n_unknowns, 1))
+    btb_samples = np.empty(n_samples + offset)
+    for i_ini in range(0, n_samples, chunk_size):
+        a_mat, b_mat, _ = get_ab_mats_assembly(slice_responses(responses, i_ini, i_ini + chunk_size), parameters,
+                                               dof_indexes, assembly=assembly)
+        n_chunk = b_mat.shape[0] // len(dof_indexes)
+        a_blocks = a_mat.reshape((len(dof_indexes), n_chunk, -1))
+        b_blocks = b_mat.reshape((len(dof_indexes), n_chunk))
+        samples = slice(offset + i_ini, offset + i_ini + n_chunk)
+        np.einsum('dtp,dtq->tpq', a_blocks, a_blocks, out=ata_samples[samples])
+        np.einsum('dtp,dt->tp', a_blocks, b_blocks, out=atb_samples[samples, :, 0])
+        np.einsum('dt,dt->t', b_blocks, b_blocks, out=btb_samples[samples])
+    if block_size is not None:
+        for sample_array in (ata_samples, atb_samples, btb_samples):
+            sample_array[0] = 0
+            for i_ini in range(1, n_samples + 1, block_size):
+                block = sample_array[i_ini:i_ini + block_size]
+                np.cumsum(block, axis=0, out=block)
+    return ata_samples, atb_samples, btb_samples, elements_assembly
+
+
+def window_sums(block_prefix: np.ndarray, i_ini: np.ndarray, i_fin: np.ndarray, block_size: int):
+    """
+    Returns the sums over the samples i_ini:i_fin of each window from the block prefix sums of get_sample_grams, for
+    windows of up to block_size samples, which span at most two blocks. Each sum is a difference of partial sums of
+    the one or two blocks of the window, so its error is relative to the magnitude of the samples near the window.
+    """
+    n_samples = block_prefix.shape[0] - 1
+    shape = (-1,) + (1,) * (block_prefix.ndim - 1)
+    heads = np.where((i_ini % block_size != 0).reshape(shape), block_prefix[i_ini], 0)
+    first_block_ends = np.minimum((i_ini // block_size + 1) * block_size, n_samples)
+    spans_two = ((i_fin - 1) // block_size > i_ini // block_size).reshape(shape)
+    return np.where(spans_two, block_prefix[first_block_ends], 0) - heads + block_prefix[i_fin]
+
+
+def _solve_groups(ata_mats, atb_mats, btb_vals, n_rows, names):
+    gamma_mats = solve_gram_batch(ata_mats, atb_mats)
+    gammas = gamma_mats[:, :, 0]
+    residual_ss = btb_vals - 2 * np.einsum('wp,wp->w', gammas, atb_mats[:, :, 0]) + \
+        np.einsum('wp,wpq,wq->w', gammas, ata_mats, gammas)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        residual_rms = np.sqrt(np.maximum(residual_ss, 0) / n_rows)
+    return {'unknown': {name: gammas[:, i_name] for i_name, name in enumerate(names)}, 'residual_rms': residual_rms}
+
+
+def sliding_window_identification(responses: List[dict], parameters: dict, dof_indexes: List[int], window: int,
+                                  step: int = 1, t: np.ndarray = None, chunk_size: int = 2 ** 14):
+    """
+    Identifies the parameters on moving windows of window samples, every step samples. The per sample normal
+    equations are prefix summed once, in place and by blocks of window samples (see window_sums), so each window
+    costs a p x p solve, whatever its length.
+
+    :returns: dict with 'i_ini' (first sample of each window), 't' (time at the center of each window, if t is
+    given), 'unknown' (name -> trajectory of the parameter over the windows) and 'residual_rms' (RMS of the force
+    residual over the dofs on each window).
+    """
+    n_samples = check_responses_integrity(responses)
+    assert 0 < window <= n_samples, 'window must be between 1 and the number of samples'
+    *prefixes, elements = get_sample_grams(responses, parameters, dof_indexes, chunk_size, block_size=window)
+    i_ini = np.arange(0, n_samples - window + 1, step)
+    i_fin = i_ini + window
+    trajectories = _solve_groups(*[window_sums(prefix, i_ini, i_fin, window) for prefix in prefixes],
+                                 window * len(dof_indexes), unknown_names(parameters, elements))
+    trajectories['i_ini'] = i_ini
+    if t is not None:
+        trajectories['t'] = t[i_ini + window // 2]
+    return trajectories
+
+
+def relative_amplitude(responses: List[dict], i: int, j: int, envelope_window: int = 101):
+    """
+    Returns, for each sample, the amplitude of the relative displacement between dofs i and j, estimated as the
+    maximum of |x_i - x_j| on a centered window of envelope_window samples (about one period of the slowest mode).
+    """
+    relative_disp = np.abs(responses[i]['x'] - responses[j]['x'])
+    half = envelope_window // 2
+    padded = np.pad(relative_disp, (half, envelope_window - 1 - half), mode='edge')
+    return sliding_window_view(padded, envelope_window).max(axis=1)
+
+
+def amplitude_binned_identification(responses: List[dict], parameters: dict, dof_indexes: List[int],
+                                    amplitude_pair=(1, 0), bin_edges=None, n_bins: int = 10,
+                                    envelope_window: int = 101, chunk_size: int = 2 ** 14):
+    """
+    Identifies the parameters separately on bins of the amplitude of the relative displacement between the dofs in
+    amplitude_pair (see relative_amplitude). The per sample normal equations are computed once and reduced per bin.
+
+    :param bin_edges: Amplitude edges of the bins. By default, n_bins bins with the same number of samples.
+    :returns: dict with 'bin_edges', 'n_samples' (per bin), 'unknown' (name -> parameter on each bin) and
+    'residual_rms'. Empty bins get nan.
+    """
+    ata_samples, atb_samples, btb_samples, elements = get_sample_grams(responses, parameters, dof_indexes, chunk_size)
+    amplitude = relative_amplitude(responses, *amplitude_pair, envelope_window=envelope_window)
+    if bin_edges is None:
+        bin_edges = np.quantile(amplitude, np.linspace(0, 1, n_bins + 1))
+    bin_edges = np.asarray(bin_edges, dtype=float)
+    n_bins = bin_edges.shape[0] - 1
+    bin_ids = np.clip(np.searchsorted(bin_edges, amplitude, side='right') - 1, 0, n_bins - 1)
+    in_range = (amplitude >= bin_edges[0]) & (amplitude <= bin_edges[-1])
+    order = np.flatnonzero(in_range)[np.argsort(bin_ids[in_range], kind='stable')]
+    counts = np.bincount(bin_ids[in_range], minlength=n_bins)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    filled = counts > 0
+    ata_bins = np.zeros((n_bins,) + ata_samples.shape[1:])
+    atb_bins = np.zeros((n_bins,) + atb_samples.shape[1:])
+    btb_bins = np.zeros(n_bins)
+    if np.any(filled):
+        ata_bins[filled] = np.add.reduceat(ata_samples[order], starts[filled], axis=0)
+        atb_bins[filled] = np.add.reduceat(atb_samples[order], starts[filled], axis=0)
+        btb_bins[filled] = np.add.reduceat(btb_samples[order], starts[filled], axis=0)
+    trajectories = _solve_groups(ata_bins, atb_bins, btb_bins, counts * len(dof_indexes),
+                                 unknown_names(parameters, elements))
+    for name in trajectories['unknown']:
+        trajectories['unknown'][name][~filled] = np.nan
+    trajectories['residual_rms'][~filled] = np.nan
+    trajectories['bin_edges'] = bin_edges
+    trajectories['n_samples'] = counts
+    return trajectories